@@ -0,0 +1,164 @@
+"""
+"How lucky was this roll": percentile ranks of results, from exact distributions stored in the cache
+shared by the bot and the archive, keyed by canonical expression.
+"""
+import logging
+import typing
+from array import array
+from collections import Counter
+from functools import lru_cache
+
+from django.core.cache import cache
+
+import dice
+import probability
+from play_trpg.celery import app
+from .models import Log, LogKind
+
+logger = logging.getLogger(__name__)
+
+# wider distributions are not stored
+MAX_STORED_RANGE = 10000
+# stored when there is no distribution for an expression, so it is not computed again
+MISSING = (0, b'')
+# seconds before an expression requested to be stored can be requested again
+REQUEST_TIMEOUT = 600
+POPULAR = (
+    '1d4', '1d6', '1d8', '1d10', '1d12', '1d20', '1d100',
+    '2d6', '3d6', '4d6', '2d10', '2d20', 'max(2d20)', 'min(2d20)',
+    '4d6kh3', '2d20kh1', '2d20kl1',
+)
+
+Ranks = typing.Tuple[int, array]
+
+
+def distribution_key(expression: str) -> str:
+    return 'distribution:{}'.format(expression)
+
+
+def compute(expression: str):
+    # canonical expressions name every face, the default face is never used
+    try:
+        # refused before the distribution is computed, it would not be stored
+        if probability.expression_range(expression, 20) > MAX_STORED_RANGE:
+            return MISSING
+        distribution = probability.expression_distribution(expression, 20)
+    except dice.RollError:
+        return MISSING
+    if distribution is None or len(distribution.counts) > MAX_STORED_RANGE:
+        return MISSING
+    return distribution.offset, array('f', distribution.ranks()).tobytes()
+
+
+def load(stored) -> typing.Optional[Ranks]:
+    offset, data = stored
+    if not data:
+        return None
+    ranks = array('f')
+    ranks.frombytes(data)
+    return offset, ranks
+
+
+@lru_cache(maxsize=1024)
+def get_ranks(expression: str) -> typing.Optional[Ranks]:
+    """
+    Read the stored distribution, or compute and store it.
+    """
+    key = distribution_key(expression)
+    stored = cache.get(key)
+    if stored is None:
+        stored = compute(expression)
+        cache.set(key, stored, None)
+    return load(stored)
+
+
+@app.task
+def store_ranks_task(expression: str):
+    cache.add(distribution_key(expression), compute(expression), None)
+
+
+def request_ranks(expression: str):
+    """
+    Store the distribution in the background, unless it is stored already or too wide to be.
+    Errors are logged, the reply of the roll is sent already.
+    """
+    key = distribution_key(expression)
+    if cache.get(key) is not None:
+        return
+    try:
+        too_wide = probability.expression_range(expression, 20) > MAX_STORED_RANGE
+    except dice.RollError:
+        too_wide = True
+    if too_wide:
+        cache.set(key, MISSING, None)
+        return
+    # one task at a time for an expression, requested again if it is lost
+    requested_key = 'distribution_requested:{}'.format(expression)
+    if not cache.add(requested_key, True, REQUEST_TIMEOUT):
+        return
+    try:
+        store_ranks_task.delay(expression)
+    except Exception:
+        cache.delete(requested_key)
+        logger.exception('Failed to request the distribution of %s', expression)
+
+
+def get_stored_ranks(expressions: typing.Iterable[str]) -> typing.Dict[str, Ranks]:
+    """
+    Only what is stored already, never computes.
+    """
+    keys = {distribution_key(expression): expression for expression in expressions}
+    result = {}
+    for key, stored in cache.get_many(list(keys)).items():
+        ranks = load(stored)
+        if ranks is not None:
+            result[keys[key]] = ranks
+    return result
+
+
+def luck(ranks: Ranks, value) -> typing.Optional[float]:
+    """
+    Share of all results lower than `value`, in percent.
+    """
+    offset, table = ranks
+    if not isinstance(value, int) or not 0 <= value - offset < len(table):
+        return None
+    return table[value - offset] * 100
+
+
+def roll_objects(logs) -> typing.Iterator[dict]:
+    for log in logs:
+        for obj in log.entity_objects:
+            if obj.get('kind') == 'roll' and obj.get('expression'):
+                yield obj
+
+
+def annotate_luck(logs):
+    """
+    Set `luck_list` on the logs, the expression and the luck of each roll already stored.
+    The badges are shown next to the stored html, which never depends on luck.
+    """
+    logs = list(logs)
+    stored = get_stored_ranks({obj['expression'] for obj in roll_objects(logs)})
+    for log in logs:
+        log.luck_list = []
+        for obj in roll_objects((log,)):
+            ranks = stored.get(obj['expression'])
+            value = luck(ranks, obj['result']) if ranks is not None else None
+            if value is not None:
+                log.luck_list.append(dict(expression=obj['expression'], luck=value))
+
+
+def popular_expressions(recent=1000, limit=100) -> typing.List[str]:
+    counter = Counter()
+    logs = Log.objects.filter(kind=LogKind.ROLL.value).order_by('-id')[:recent]
+    for obj in roll_objects(logs.only('entities')):
+        counter[obj['expression']] += 1
+    expressions = list(POPULAR)
+    expressions.extend(expression for expression, _ in counter.most_common(limit))
+    return expressions
+
+
+def prewarm():
+    for expression in popular_expressions():
+        get_ranks(expression)
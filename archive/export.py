@@ -41,7 +41,7 @@ def json_export(_, current):
             'user_fullname': log.user_fullname,
             'character_name': log.character_name,
             'type': log.get_kind_display(),
-            'entities': log.entities,
+            'entities': log.entity_objects,
             'media': log.media_url(),
             'is_gm': log.gm,
             'created': log.created,
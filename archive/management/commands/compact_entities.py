@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from archive.models import Log, EntitiesFormat
+from entities import compact_objects
+
+
+def stored_size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+class Command(BaseCommand):
+    help = 'Rewrite Log.entities in the compact form, in chunks; run it again to resume'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=1000, help='logs updated in one transaction')
+        parser.add_argument('--dry-run', action='store_true', help='only report the bytes saved')
+
+    def handle(self, *args, **options):
+        logs = Log.objects.filter(entities_format=EntitiesFormat.OBJECT.value).order_by('id')
+        last_id = 0
+        total = before = after = 0
+        while True:
+            # the rows are locked, so the bot never edits a log between reading and writing it
+            with transaction.atomic():
+                queryset = logs.filter(id__gt=last_id).only('id', 'entities')
+                if not options['dry_run']:
+                    queryset = queryset.select_for_update()
+                chunk = list(queryset[:options['chunk']])
+                if not chunk:
+                    break
+                for log in chunk:
+                    before += stored_size(log.entities)
+                    log.entities = compact_objects(log.entities or [])
+                    log.entities_format = EntitiesFormat.COMPACT.value
+                    after += stored_size(log.entities)
+                if not options['dry_run']:
+                    Log.objects.bulk_update(chunk, ['entities', 'entities_format'])
+            last_id = chunk[-1].id
+            total += len(chunk)
+            self.stdout.write('{} logs, {} -> {} bytes'.format(total, before, after))
+        saved = before - after
+        self.stdout.write('{} logs, {} bytes saved ({:.0%})'.format(total, saved, saved / before if before else 0))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from archive.models import Log
+from entities import Entities
+
+
+class Command(BaseCommand):
+    help = 'Render the archive html of the logs, in chunks; run it again to resume'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=1000, help='logs updated in one transaction')
+        parser.add_argument('--all', action='store_true', help='render the logs already rendered again')
+
+    def handle(self, *args, **options):
+        logs = Log.objects.order_by('id')
+        if not options['all']:
+            logs = logs.filter(html='')
+        last_id = 0
+        total = 0
+        while True:
+            # the rows are locked, so the bot never edits a log between reading and writing it
+            with transaction.atomic():
+                chunk = list(logs.filter(id__gt=last_id).only('id', 'entities').select_for_update()[:options['chunk']])
+                if not chunk:
+                    break
+                for log, value in zip(chunk, Entities.from_objects(log.entities for log in chunk)):
+                    log.html = value.archive_html()
+                Log.objects.bulk_update(chunk, ['html'])
+            last_id = chunk[-1].id
+            total += len(chunk)
+            self.stdout.write('{} logs rendered'.format(total))
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0016_delete_telegramprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='entities_format',
+            field=models.IntegerField(choices=[(1, 'OBJECT'), (2, 'COMPACT')], default=1),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0017_log_entities_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='html',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
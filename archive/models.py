@@ -1,11 +1,16 @@
 import datetime
 from enum import Enum, auto
 from hashlib import sha256
-from typing import Optional
+from typing import List, Optional
 
+from django.conf import settings
 from django.db import models
 from django.db.models import Count
 from django.contrib.postgres.fields import JSONField
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from entities import Entities, stored_objects
 
 
 class LogKind(Enum):
@@ -20,6 +25,13 @@ class LogKind(Enum):
     DIVIDER = auto()
 
 
+class EntitiesFormat(Enum):
+    # a list of objects with keys
+    OBJECT = auto()
+    # a list of `[code, *fields]`, see `Entity.compact`
+    COMPACT = auto()
+
+
 def choice(enum):
     return [(kind.value, kind.name) for kind in enum]
 
@@ -47,6 +59,13 @@ class Chat(models.Model):
     gm_mode = models.BooleanField(default=False)
     gm_mode_notice = models.BigIntegerField(null=True, default=None)
 
+    def touch(self):
+        """
+        Bump `modified`, the key of the cached archive pages, without writing the other fields.
+        """
+        self.modified = timezone.now()
+        Chat.objects.filter(id=self.id).update(modified=self.modified)
+
     def recent_modified(self) -> Optional[datetime.datetime]:
         field = 'modified'
         result = self.log_set.order_by(field).values(field).first()
@@ -84,6 +103,9 @@ class Log(models.Model):
     kind = models.IntegerField(choices=choice(LogKind), default=LogKind.NORMAL.value)
     content = models.TextField(default='', blank=True, null=False)
     entities = JSONField()
+    entities_format = models.IntegerField(choices=choice(EntitiesFormat), default=EntitiesFormat.OBJECT.value)
+    # `entities` rendered for the archive, see `Entities.archive_html`
+    html = models.TextField(default='', blank=True)
     media = models.FileField(upload_to='uploads/%Y/%m/%d/', blank=True)
     gm = models.BooleanField('GM', default=False)
     reply = models.ForeignKey('Log', on_delete=models.SET_NULL, null=True, blank=True, editable=False)
@@ -92,6 +114,33 @@ class Log(models.Model):
     modified = models.DateTimeField(auto_now=True)
     tag = models.ManyToManyField('Tag')
 
+    @staticmethod
+    def encode_entities(value: Entities) -> dict:
+        """
+        Values of `entities`, `entities_format` and `html`, compact if `COMPACT_LOG_ENTITIES` is set.
+        """
+        if settings.COMPACT_LOG_ENTITIES:
+            fields = dict(entities=value.to_compact(), entities_format=EntitiesFormat.COMPACT.value)
+        else:
+            fields = dict(entities=value.to_object(), entities_format=EntitiesFormat.OBJECT.value)
+        fields['html'] = value.archive_html()
+        return fields
+
+    def set_entities(self, value: Entities):
+        for name, field_value in self.encode_entities(value).items():
+            setattr(self, name, field_value)
+
+    @cached_property
+    def entity_objects(self) -> List[dict]:
+        """
+        The entities as objects, in either format.
+        """
+        return stored_objects(self.entities or [])
+
+    def render_html(self) -> str:
+        # either format is decoded as it is stored
+        return Entities.from_object(self.entities or []).archive_html()
+
     def reply_message_id(self):
         if self.reply:
             return self.reply.message_id
@@ -1 +1,101 @@
-# Create your tests here.
+from types import SimpleNamespace
+from unittest import mock
+
+import telegram
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from archive import distributions
+from archive.models import Chat, Log, LogKind
+from bot import tasks
+from bot.bot import handle_message
+from game.models import Player
+
+CHAT_ID = -1001
+USER_ID = 42
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class HandleMessageQueriesTest(TestCase):
+    """
+    Queries of the hot paths, the Bot API calls and the scheduled deletions are stubbed.
+    """
+
+    def setUp(self):
+        self.chat = Chat.objects.create(chat_id=CHAT_ID, title='Test')
+        Player.objects.create(chat_id=CHAT_ID, user_id=USER_ID, character_name='Alice', full_name='Alice')
+        self.bot = mock.Mock(spec=telegram.Bot)
+        self.sent = []
+        for target, name, stub in (
+            (tasks.outbox, 'call', self.call),
+            (tasks.outbox, 'submit', mock.Mock()),
+            (tasks.deletions, 'schedule', mock.Mock()),
+            ('archive.distributions', 'request_ranks', mock.Mock()),
+        ):
+            if isinstance(target, str):
+                patcher = mock.patch('{}.{}'.format(target, name), stub)
+            else:
+                patcher = mock.patch.object(target, name, stub)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call(self, chat_id, _priority, func, *_args, **_kwargs):
+        self.sent.append(func)
+        return SimpleNamespace(chat_id=chat_id, message_id=1000 + len(self.sent))
+
+    def handle(self, text: str):
+        message = telegram.Message(
+            message_id=len(self.sent) + 1,
+            date=timezone.now(),
+            chat=telegram.Chat(CHAT_ID, 'supergroup', title='Test'),
+            from_user=telegram.User(USER_ID, 'Alice', False, language_code='en'),
+            text=text,
+            bot=self.bot,
+        )
+        update = telegram.Update(1, message=message)
+        handle_message(update, SimpleNamespace(bot=self.bot, job_queue=mock.Mock()))
+
+    def test_roll(self):
+        # the chat, the roster, the log and `modified` of the chat
+        with self.assertNumQueries(4):
+            self.handle('.r 1d20+5')
+        self.assertEqual(len(self.sent), 1)
+        log = Log.objects.get(chat=self.chat)
+        self.assertEqual(log.kind, LogKind.ROLL.value)
+        self.assertIn('entity-roll', log.html)
+
+    def test_say(self):
+        # the chat, the roster, the log and `modified` of the chat
+        with self.assertNumQueries(4):
+            self.handle('.hello world')
+        self.assertEqual(len(self.sent), 1)
+        log = Log.objects.get(chat=self.chat)
+        self.assertEqual(log.kind, LogKind.NORMAL.value)
+        self.assertEqual(log.character_name, 'Alice')
+        self.assertGreater(Chat.objects.get(id=self.chat.id).modified, self.chat.modified)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RequestRanksTest(SimpleTestCase):
+    """
+    A failed request of a distribution is logged and requested again on the next roll.
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_failed_delay(self):
+        with mock.patch.object(distributions.store_ranks_task, 'delay', side_effect=OSError) as delay:
+            with self.assertLogs('archive.distributions'):
+                distributions.request_ranks('2d6')
+            with self.assertLogs('archive.distributions'):
+                distributions.request_ranks('2d6')
+        self.assertEqual(delay.call_count, 2)
+
+    def test_requested_once(self):
+        with mock.patch.object(distributions.store_ranks_task, 'delay') as delay:
+            distributions.request_ranks('2d6')
+            distributions.request_ranks('2d6')
+        delay.assert_called_once_with('2d6')
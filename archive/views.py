@@ -7,6 +7,7 @@ from django.views.decorators.cache import cache_page
 from django.core.paginator import Paginator
 
 from . import forms
+from .distributions import annotate_luck
 from .export import EXPORT_METHOD
 from .models import Chat, Tag
 from user.models import TelegramProfile
@@ -63,6 +64,7 @@ def chat_page(request, chat_id):
             log_set = log_set.filter(content__icontains=keyword)
     paginator = Paginator(log_set, per_page=150)
     page = paginator.page(page_number)
+    annotate_luck(page)
     context = dict(
         chat=chat,
         page_number=page_number,
@@ -0,0 +1,233 @@
+"""
+Micro benchmarks of the dice engine, run with `python benchmark.py` or `python manage.py dice_bench`.
+"""
+import re
+import secrets
+import timeit
+import tracemalloc
+
+import dice
+import entities
+import roller
+
+NARRATIVE = (
+    '夜色渐深，调查员们在旧宅的走廊里停下脚步。他拔出长剑，1d20+5 攻击，然后 2d6*3 伤害！'
+    '「这里不对劲……」她低声说道，侦查 1d100，聆听 1d100。'
+    'The door creaks open; max(2d20) for initiative, 最小（2d20） for the cursed one. '
+) * 8
+
+
+def allocated(func, number=10) -> int:
+    """
+    Peak bytes allocated by one call, averaged over `number` calls.
+    """
+    func()
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(number):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - base
+    finally:
+        tracemalloc.stop()
+    return total // number
+
+
+def bench(name, func, number=1000):
+    elapsed = timeit.timeit(func, number=number)
+    print('{:<32} {:>14.1f} ops/sec {:>12} B/call'.format(name, number / elapsed, allocated(func)))
+
+
+def rng_benchmarks():
+    for face, counter in ((20, 1), (6, 4), (100, 999)):
+        name = '{}d{}'.format(counter, face)
+        yield 'secrets ' + name, lambda face=face, counter=counter: [secrets.randbelow(face) + 1 for _ in range(counter)]
+        yield 'pool ' + name, lambda face=face, counter=counter: roller.roll(face, counter)
+
+
+def pool_benchmarks():
+    for face, counter in ((6, 9999), (100, 9999), (9999, 9999)):
+        name = '{}d{}'.format(counter, face)
+        yield 'list sum ' + name, lambda face=face, counter=counter: sum(roller.roll(face, counter))
+        yield 'packed sum ' + name, lambda face=face, counter=counter: roller.roll_reduce(face, counter)
+
+
+def two_pass_eval(expr, env):
+    """
+    The former `Expr.eval`, kept to compare with.
+    """
+    value_list = []
+    show_list = []
+    for i in expr:
+        if not isinstance(i, dice.Operator):
+            v, show = i.eval(env)
+            value_list.append(v)
+            show_list.append(show)
+        else:
+            show_list.append(i.display)
+            value_list.append(i)
+    for i, current in enumerate(value_list):
+        if isinstance(current, (dice.Mul, dice.Div)):
+            a = value_list[i - 1]
+            b = value_list[i + 1]
+            value_list[i + 1] = a * b if isinstance(current, dice.Mul) else a // b
+            value_list[i] = None
+            value_list[i - 1] = None
+    value_list = list(filter(lambda x: x is not None, value_list))
+    result = value_list[0]
+    for i, current in enumerate(value_list):
+        if isinstance(current, dice.Add):
+            result += value_list[i + 1]
+        elif isinstance(current, dice.Sub):
+            result -= value_list[i + 1]
+    return result, '[{}]={}'.format(' '.join(show_list), result)
+
+
+def recursive_eval(node, env):
+    """
+    The former `Group.eval`, every `BinaryOp` of the tree evaluated by recursion, kept to compare with.
+    """
+    if isinstance(node, dice.Group):
+        result, show = recursive_eval(node.root, env)
+        return result, '[{}]={}'.format(show, result)
+    elif not isinstance(node, dice.BinaryOp):
+        return node.eval(env)
+    a, a_show = recursive_eval(node.left, env)
+    b, b_show = recursive_eval(node.right, env)
+    op = node.op
+    if isinstance(op, dice.Add):
+        result = a + b
+    elif isinstance(op, dice.Sub):
+        result = a - b
+    elif isinstance(op, dice.Mul):
+        result = a * b
+    else:
+        result = a // b
+    return result, '{} {} {}'.format(a_show, op.display, b_show)
+
+
+def expr_benchmarks():
+    env = dice.Env(face=20)
+    for text in ('1d20+5', '2d6*3+1d4', '1d100-20', '2*3+4*5-6/2*3+1d20*2'):
+        expr = dice.parse(text, dice.Expr)
+        yield 'two pass ' + text, lambda expr=expr: two_pass_eval(expr, env)
+        group = dice.parse_roll(text, 'pratt')[0]
+        yield 'recursive ' + text, lambda group=group: recursive_eval(group, env)
+        # the path of the bot, through the parse cache
+        for parser in dice.PARSERS:
+            yield 'roll_entities {} {}'.format(parser, text), \
+                lambda text=text, parser=parser: dice.roll_entities(text, 20, parser)
+
+
+def dice_benchmarks():
+    env = dice.Env(face=20)
+    for text in ('1d20+5', '2d6*3 伤害', '9999d100', '4d6kh3', '999d100kh3', '8d6!'):
+        yield 'roll ' + text, lambda text=text: dice.roll(text, 20)
+        yield 'roll_entities ' + text, lambda text=text: dice.roll_entities(text, 20)
+    # the reference grammar keeps flat `Expr` lists, `×` and `÷` are folded before `+` and `-`
+    expr = dice.parse('2*3+4*5-6/2*3+1d20*2', dice.Expr)
+    yield 'Expr.eval precedence', lambda: expr.eval(env)
+    for text in ('max(4d20)', '最小（4d20）'):
+        node = dice.parse(text, dice.Max if text.startswith('max') else dice.Min)
+        yield 'eval ' + text, lambda node=node: node.eval(env)
+    # longer than the parse cache accepts, so every call parses the text again
+    for parser in dice.PARSERS:
+        yield 'narrative {} chars {}'.format(len(NARRATIVE), parser), \
+            lambda parser=parser: dice.roll_entities(NARRATIVE, 20, parser)
+
+
+CODE_REGEX = re.compile(r'<(code)>(.+?)</code>')
+BOLD_REGEX = re.compile(r'<(b)>(.+?)</b>')
+
+
+def two_regex_entities(content):
+    """
+    The former `entities.convert_to_entities`, kept to compare with.
+    """
+    matches = list(CODE_REGEX.finditer(content))
+    matches.extend(BOLD_REGEX.finditer(content))
+    matches.sort(key=lambda m: m.start())
+    result = []
+    last_index = 0
+    for match in matches:
+        tag = match.group(1)
+        text = match.group(2)
+        start = match.start()
+        if start < last_index:
+            continue
+        segment = content[last_index:start]
+        if segment:
+            result.append(entities.Span(segment))
+        last_index = match.end()
+        if tag == 'code':
+            result.append(entities.Code(text))
+        elif tag == 'b':
+            result.append(entities.Bold(text))
+    if last_index < len(content) - 1:
+        result.append(entities.Span(content[last_index:]))
+    return result
+
+
+def replace_escape(text):
+    text = text.replace('&', '&amp;')
+    text = text.replace('<', '&lt;')
+    text = text.replace('>', '&gt;')
+    return text
+
+
+def format_telegram_html(xs):
+    """
+    The former `entities.entities_to_telegram_html`, a formatted string for each entity.
+    """
+    pieces = []
+    for entity in xs:
+        if isinstance(entity, entities.RollResult):
+            pieces.append(' <code>{}</code> '.format(replace_escape(entity.value)))
+        elif isinstance(entity, entities.Code):
+            pieces.append('<code>{}</code>'.format(replace_escape(entity.value)))
+        elif isinstance(entity, (entities.Bold, entities.Character)):
+            pieces.append('<b>{}</b>'.format(replace_escape(entity.value)))
+        else:
+            pieces.append(entity.telegram_html())
+    return ''.join(pieces).strip()
+
+
+def entities_benchmarks():
+    roll_html = entities.Entities(dice.roll_entities(NARRATIVE, 20)).telegram_html()
+    for name, content in (('plain', NARRATIVE), ('rolls', roll_html), ('rolls x16', roll_html * 16)):
+        name = '{} {} chars'.format(name, len(content))
+        yield 'two regex ' + name, lambda content=content: two_regex_entities(content)
+        yield 'convert_to_entities ' + name, lambda content=content: entities.convert_to_entities(content)
+    # the stored entities of a page of logs
+    page = [entities.Entities(dice.roll_entities('他拔出长剑，1d20+5 攻击。', 20)).to_object()] * 100
+    yield 'from_objects 100 logs', lambda: entities.Entities.from_objects(page)
+    decoded = entities.Entities.from_objects(page)
+    yield 'to_object 100 logs', lambda: [x.to_object() for x in decoded]
+    rolled = entities.Entities(dice.roll_entities(NARRATIVE + '<b>&</b> "<i>"', 20))
+    yield 'format telegram_html', lambda: format_telegram_html(rolled.list)
+    yield 'telegram_html', rolled.telegram_html
+    yield 'archive_html', rolled.archive_html
+
+
+GROUPS = {
+    'rng': (rng_benchmarks, 1000),
+    'pool': (pool_benchmarks, 100),
+    'dice': (dice_benchmarks, 200),
+    'expr': (expr_benchmarks, 10000),
+    'entities': (entities_benchmarks, 1000),
+}
+
+
+def main(groups=None, seed=None):
+    roller.use_seed(seed)
+    for group in groups or GROUPS:
+        benchmarks, number = GROUPS[group]
+        for name, func in benchmarks():
+            bench(name, func, number=number)
+
+
+if __name__ == '__main__':
+    main()
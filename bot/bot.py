@@ -12,20 +12,23 @@ from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, Callb
     JobQueue
 from django.conf import settings
 
+import roller
 from bot.say import handle_as_say, handle_say, get_tag
 from bot.system import Deletion
 from bot.variable import handle_list_variables, handle_variable_assign, handle_clear_variables
 from .roll import set_dice_face, handle_coc_roll, handle_loop_roll, handle_normal_roll, hide_roll_callback, \
-    handle_set_dice_face
+    handle_set_dice_face, handle_probability, handle_simulation
 from .character_name import set_name, get_name
 from .round_counter import round_inline_callback, start_round, hide_round, \
     public_round, next_turn, handle_initiative, handle_start_round
-from . import patterns
+from . import metrics, patterns, webhook
+from .workers import ChatWorkers
 from .display import Text, get_by_user, get
-from .system import Context, is_group_chat, is_gm, get_chat, get_player_by_id
+from .system import Context, Roster, is_group_chat, is_gm, get_chat
 from bot.tasks import send_message, delete_message, cancel_delete_message, after_edit_delete_previous_message, \
-    error_message, timer_message
+    error_message, timer_message, edit_message, edit_message_caption, answer_callback_query, outbox, REPLY
 
+from archive import distributions
 from archive.models import Chat, Log
 from game.models import Player, Variable
 
@@ -80,7 +83,7 @@ def handle_save(message: telegram.Message, job_queue, **_kwargs):
         chat.recording = False
         chat.save_date = datetime.datetime.now()
         chat.save()
-        message.chat.send_message('#save {}'.format(_(Text.SAVE)))
+        send_message(job_queue, message.chat_id, '#save {}'.format(_(Text.SAVE)), parse_mode=None)
     else:
         error_message(job_queue, message, _(Text.ALREADY_SAVED))
 
@@ -92,7 +95,8 @@ def help_command(update, _context: CallbackContext):
 
 def handle_help(message: telegram.Message, **_kwargs):
     send_text = get_by_user(Text.HELP_TEXT, message.from_user)
-    message.reply_text(send_text, parse_mode='HTML', reply_markup=login_button())
+    reply = partial(message.reply_text, send_text, parse_mode='HTML', reply_markup=login_button())
+    outbox.submit(message.chat_id, REPLY, reply, send=True)
 
 
 def handle_delete_callback(query: telegram.CallbackQuery, context: CallbackContext):
@@ -104,18 +108,18 @@ def handle_delete_callback(query: telegram.CallbackQuery, context: CallbackConte
     assert isinstance(message, telegram.Message)
     deletion = Deletion.get(message.chat_id, message.message_id)
     if not deletion:
-        query.answer(_(Text.INTERNAL_ERROR), alert=True)
+        answer_callback_query(job_queue, query.id, _(Text.INTERNAL_ERROR), show_alert=True)
         delete_message(job_queue, message.chat_id, message.message_id)
         return
     if deletion.user_id != query.from_user.id:
-        query.answer(_(Text.MUST_SAME_USER))
+        answer_callback_query(job_queue, query.id, _(Text.MUST_SAME_USER))
         return
     delete_message(job_queue, message.chat_id, message.message_id)
     if query.data == 'delete:cancel':
-        query.answer(_(Text.CANCELED))
+        answer_callback_query(job_queue, query.id, _(Text.CANCELED))
     elif query.data == 'delete:confirm':
         deletion.do()
-        query.answer(_(Text.DELETED))
+        answer_callback_query(job_queue, query.id, _(Text.DELETED))
 
 
 def timer_next_callback(job_queue: JobQueue, query: telegram.CallbackQuery, data: str):
@@ -126,9 +130,10 @@ def timer_next_callback(job_queue: JobQueue, query: telegram.CallbackQuery, data
         if len(comment) > 128:
             raise ValueError()
     except ValueError:
-        query.answer("wrong timer callback arguments")
+        answer_callback_query(job_queue, query.id, "wrong timer callback arguments")
+        return
     timer_message(job_queue, query.message.chat_id, timer, comment)
-    query.answer()
+    answer_callback_query(job_queue, query.id)
 
 
 def inline_callback(update, context: CallbackContext):
@@ -142,11 +147,13 @@ def inline_callback(update, context: CallbackContext):
     elif data.startswith('timer'):
         timer_next_callback(context.job_queue, query, data)
     elif data.startswith('hide_roll'):
-        hide_roll_callback(bot, update)
+        hide_roll_callback(context.job_queue, query)
     elif data.startswith('delete'):
         handle_delete_callback(query, context)
     else:
-        query.answer(show_alert=True, text=get_by_user(Text.UNKNOWN_COMMAND, query.from_user))
+        answer_callback_query(
+            context.job_queue, query.id, get_by_user(Text.UNKNOWN_COMMAND, query.from_user), show_alert=True
+        )
 
 
 def delete_reply_markup(language_code: str):
@@ -164,6 +171,7 @@ def handle_delete(
         message: telegram.Message,
         player: Player,
         job_queue,
+        roster: Roster,
         **_):
     target = message.reply_to_message
     variables = patterns.VARIABLE_REGEX.findall(message.text)
@@ -178,9 +186,9 @@ def handle_delete(
                 log = Log.objects.filter(chat=chat, message_id=target.message_id, deleted=False).first()
                 if not log:
                     return error_message(job_queue, message, _(Text.RECORD_NOT_FOUND))
-                target_player = get_player_by_id(chat.chat_id, log.user_id)
+                target_player = roster.get_player(log.user_id)
             else:
-                target_player = get_player_by_id(message.chat_id, target.from_user.id)
+                target_player = roster.get_player(target.from_user.id)
         if not target_player:
             return error_message(job_queue, message, _(Text.INVALID_TARGET))
         delete_log = ''
@@ -211,7 +219,7 @@ def handle_delete(
         if log is None:
             error_message(job_queue, message, get_by_user(Text.RECORD_NOT_FOUND, message.from_user))
             return
-        elif log.user_id != user_id and not is_gm(message.chat_id, user_id):
+        elif log.user_id != user_id and not roster.is_gm(user_id):
             error_message(job_queue, message, get_by_user(Text.HAVE_NOT_PERMISSION, message.from_user))
             return
         character_name = "<b>{}</b>".format(log.temp_character_name or log.character_name)
@@ -219,7 +227,8 @@ def handle_delete(
         reply_markup = delete_reply_markup(message.from_user.language_code)
         deletion = Deletion(message.chat_id, message.from_user.id, message_list=[log.message_id])
     delete_message(job_queue, message.chat_id, message.message_id)
-    sent = message.chat.send_message(check_text, parse_mode='HTML', reply_markup=reply_markup)
+    send = partial(message.chat.send_message, check_text, parse_mode='HTML', reply_markup=reply_markup)
+    sent = outbox.call(message.chat_id, REPLY, send, send=True)
     deletion.set(sent.message_id)
     delete_message(job_queue, message.chat_id, sent.message_id, 30)
 
@@ -266,15 +275,10 @@ def handle_add_tag(bot: telegram.Bot, chat, message: telegram.Message, job_queue
 
     if target.photo:
         edit_text = str(target.caption_html) + tag_text
-        bot.edit_message_caption(
-            chat_id=target.chat_id,
-            message_id=target.message_id,
-            caption=edit_text,
-            parse_mode='HTML',
-        )
+        edit_message_caption(job_queue, target.chat_id, target.message_id, edit_text)
     else:
         edit_text = str(target.text_html) + tag_text
-        target.edit_text(edit_text, parse_mode='HTML')
+        edit_message(job_queue, target.chat_id, target.message_id, edit_text)
 
     for tag in tag_list:
         log.tag.add(tag)
@@ -284,7 +288,8 @@ def handle_add_tag(bot: telegram.Bot, chat, message: telegram.Message, job_queue
     delete_message(job_queue, message.chat_id, message.message_id)
 
 
-def handle_edit(job_queue: JobQueue, chat, bot, message: telegram.Message, start: int, with_photo=None, **_kwargs):
+def handle_edit(job_queue: JobQueue, chat, bot, message: telegram.Message, start: int, with_photo=None, roster=None,
+                **_kwargs):
     target = message.reply_to_message
     assert isinstance(message.from_user, telegram.User)
     user_id = message.from_user.id
@@ -307,10 +312,11 @@ def handle_edit(job_queue: JobQueue, chat, bot, message: telegram.Message, start
 
     if log.user_id != user_id:
         return error_message(job_queue, message, _(Text.HAVE_NOT_PERMISSION))
-    handle_say(job_queue, chat, message, log.character_name, edit_log=log, with_photo=with_photo, start=start)
+    handle_say(job_queue, chat, message, log.character_name, edit_log=log, with_photo=with_photo, start=start,
+               roster=roster)
 
 
-def handle_lift(message: telegram.Message, chat: Chat, job_queue: JobQueue, **_kwargs):
+def handle_lift(message: telegram.Message, chat: Chat, job_queue: JobQueue, roster: Roster, **_kwargs):
     assert isinstance(message, telegram.Message)
     reply_to = message.reply_to_message
     user_id = message.from_user.id
@@ -321,13 +327,13 @@ def handle_lift(message: telegram.Message, chat: Chat, job_queue: JobQueue, **_k
         return error_message(job_queue, message, _(Text.NEED_REPLY))
     elif reply_to.from_user.id == message.bot.id:
         return error_message(job_queue, message, _(Text.NEED_REPLY_PLAYER_RECORD))
-    elif reply_to.from_user.id != user_id and not is_gm(message.chat_id, user_id):
+    elif reply_to.from_user.id != user_id and not roster.is_gm(user_id):
         return error_message(job_queue, message, _(Text.HAVE_NOT_PERMISSION))
     name = get_name(reply_to)
     if not name:
         return error_message(job_queue, message, _(Text.INVALID_TARGET))
     with_photo = get_maximum_photo(reply_to)
-    handle_say(job_queue, chat, reply_to, name, with_photo=with_photo)
+    handle_say(job_queue, chat, reply_to, name, with_photo=with_photo, roster=roster)
     delete_message(job_queue, reply_to.chat_id, reply_to.message_id)
     delete_message(job_queue, message.chat_id, message.message_id)
 
@@ -366,6 +372,8 @@ message_handlers = [
     (re.compile(r'^[.。[【](hd)\b'), handle_normal_roll),
     (re.compile(r'^[.。[【](loh?)\b'), handle_loop_roll),
     (re.compile(r'^[.。[【](coch?[+\-]?h?)\s*'), handle_coc_roll),
+    (re.compile(r'^[.。[【](prob)\b'), handle_probability),
+    (re.compile(r'^[.。[【](sim[+\-]?)(?![a-z])\s*'), handle_simulation),
     (re.compile(r'^[.。[【](init)\b'), handle_initiative),
     (re.compile(r'^[.。[【](set)\b'), handle_variable_assign),
     (re.compile(r'^[.。[【](list)\b'), handle_list_variables),
@@ -377,6 +385,8 @@ message_handlers = [
     (re.compile(r'^[.。[【](tag)\b'), handle_add_tag),
 ]
 
+dispatcher = patterns.Dispatcher(message_handlers)
+
 
 def start_gm_mode(bot: telegram.Bot, message: telegram.Message, chat: Chat):
     _ = partial(get_by_user, user=message.from_user)
@@ -384,7 +394,8 @@ def start_gm_mode(bot: telegram.Bot, message: telegram.Message, chat: Chat):
         return
     chat.gm_mode = True
     chat.save()
-    sent = bot.send_message(chat.chat_id, _(Text.START_GM_MODE), parse_mode='HTML')
+    send = partial(bot.send_message, chat.chat_id, _(Text.START_GM_MODE), parse_mode='HTML')
+    sent = outbox.call(chat.chat_id, REPLY, send, send=True)
     chat.gm_mode_notice = sent.message_id
     chat.save()
 
@@ -451,11 +462,13 @@ def handle_message(update: telegram.Update, context: CallbackContext):
         return
 
     if not is_group_chat(message.chat):
-        message.reply_text(_(Text.NOT_GROUP))
+        outbox.submit(message.chat_id, REPLY, partial(message.reply_text, _(Text.NOT_GROUP)), send=True)
         return
 
     chat = get_chat(message.chat)
-    player = get_player_by_id(message.chat_id, message.from_user.id)
+    # the players of the chat, shared by the handlers of this update
+    roster = Roster(message.chat_id)
+    player = roster.get_player(message.from_user.id)
 
     # handle GM mode
     if player and player.is_gm and (is_start_gm_mode(text) or is_finish_gm_mode(text)):
@@ -490,11 +503,10 @@ def handle_message(update: telegram.Update, context: CallbackContext):
 
     name = player.character_name
 
-    for pattern, handler in message_handlers:
-        result = patterns.split(pattern, text)
-        if not result:
-            continue
-        command, start = result
+    result = dispatcher.match(text)
+    if result is not None:
+        handler, command, start = result
+        metrics.incr('command.{}'.format(handler.__name__))
         rest = text[start:]
         if handler is not handle_as_say and edit_log:
             after_edit_delete_previous_message(context.job_queue, edit_log.id)
@@ -512,11 +524,14 @@ def handle_message(update: telegram.Update, context: CallbackContext):
             with_photo=with_photo,
             language_code=language_code,
             edit_log=edit_log,
+            roster=roster,
             context=Context(bot, chat, player, command, name, start, rest, message,
-                            context.job_queue, language_code, with_photo, edit_log)
+                            context.job_queue, language_code, with_photo, edit_log, roster)
         )
         return
-    handle_say(context.job_queue, chat, message, name, edit_log=edit_log, with_photo=with_photo, start=1)
+    metrics.incr('command.handle_say')
+    handle_say(context.job_queue, chat, message, name, edit_log=edit_log, with_photo=with_photo, start=1,
+               roster=roster)
 
 
 def get_maximum_photo(message: telegram.Message):
@@ -569,38 +584,60 @@ def set_password(update, context: CallbackContext):
 
 def run_bot():
     """Start the bot."""
+    worker_count = settings.BOT_WORKERS
+    if settings.DICE_SEED is not None:
+        roller.use_seed(settings.DICE_SEED)
+        # one seeded stream, the updates are handled one by one in the dispatcher so a replay rolls the same dice
+        worker_count = 0
     # Create the EventHandler and pass it your bot's token.
-    updater = Updater(settings.BOT_TOKEN, use_context=True)
+    updater = Updater(settings.BOT_TOKEN, base_url=settings.BOT_API_URL, use_context=True)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
+    # the handlers run on the worker of the chat, not in the dispatcher
+    workers = ChatWorkers(worker_count)
+    on = workers.wrap
 
     # on different commands - answer in Telegram
-    dp.add_handler(CommandHandler("start", start_command))
-    dp.add_handler(CommandHandler("save", save_command))
-    dp.add_handler(CommandHandler("help", help_command))
-    dp.add_handler(CommandHandler('face', set_dice_face, pass_args=True))
-    dp.add_handler(CommandHandler('name', set_name, pass_args=True))
-    dp.add_handler(CommandHandler('round', start_round))
-    dp.add_handler(CommandHandler('public', public_round))
-    dp.add_handler(CommandHandler('hide', hide_round))
-    dp.add_handler(CommandHandler('next', next_turn))
-    dp.add_handler(CommandHandler('password', set_password, pass_args=True))
+    dp.add_handler(CommandHandler("start", on(start_command)))
+    dp.add_handler(CommandHandler("save", on(save_command)))
+    dp.add_handler(CommandHandler("help", on(help_command)))
+    dp.add_handler(CommandHandler('face', on(set_dice_face), pass_args=True))
+    dp.add_handler(CommandHandler('name', on(set_name), pass_args=True))
+    dp.add_handler(CommandHandler('round', on(start_round)))
+    dp.add_handler(CommandHandler('public', on(public_round)))
+    dp.add_handler(CommandHandler('hide', on(hide_round)))
+    dp.add_handler(CommandHandler('next', on(next_turn)))
+    dp.add_handler(CommandHandler('password', on(set_password), pass_args=True))
     dp.add_handler(MessageHandler(
         Filters.text | Filters.photo | Filters.command,
-        handle_message,
+        on(handle_message),
         pass_job_queue=True,
     ))
-    dp.add_handler(MessageHandler(Filters.status_update.new_chat_members, new_member))
-    dp.add_handler(MessageHandler(Filters.status_update, handle_status))
-    dp.add_handler(CallbackQueryHandler(inline_callback))
+    dp.add_handler(MessageHandler(Filters.status_update.new_chat_members, on(new_member)))
+    dp.add_handler(MessageHandler(Filters.status_update, on(handle_status)))
+    dp.add_handler(CallbackQueryHandler(on(inline_callback)))
     # log all errors
     # dp.add_error_handler(handle_error)
 
-    # Start the Bot
-    updater.start_polling()
+    distributions.prewarm()
+    workers.start()
+    metrics_server = metrics.serve(settings.BOT_METRICS_LISTEN, settings.BOT_METRICS_PORT)
+
+    try:
+        if settings.BOT_WEBHOOK_URL:
+            webhook.run_webhook(updater)
+            return
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+        # Start the Bot
+        updater.start_polling()
+
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+    finally:
+        workers.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
@@ -167,6 +167,15 @@ class Text(Enum):
     FINISH_GM_MODE = auto()
     PLAYER_IN_THE_GM_MODE = auto()
     TIMER_SYNTAX_ERROR = auto()
+    PROBABILITY_TOO_COMPLEX = auto()
+    PROBABILITY_USAGE = auto()
+    PROBABILITY_RESULT = auto()
+    PROBABILITY_TARGET = auto()
+    DICE_BUDGET_EXCEEDED = auto()
+    SIMULATION_USAGE = auto()
+    SIMULATION_BUSY = auto()
+    SIMULATION_RESULT = auto()
+    SIMULATION_LEVEL = auto()
 
 
 zh_hans: Dict[Text, str] = {
@@ -267,6 +276,19 @@ zh_hans: Dict[Text, str] = {
     Text.INIT_USAGE: '用法： <code>.init [数字]</code> 或 <code>.init [角色名] = [数字]</code>',
     Text.INIT_WITHOUT_ROUND: '请先用 /round 指令开启回合轮',
     Text.TIMER_SYNTAX_ERROR: '创建定时器：<code>.timer [秒数] [描述]</code>',
+    Text.PROBABILITY_TOO_COMPLEX: '表达式太复杂，无法计算概率分布',
+    Text.PROBABILITY_USAGE: '计算概率分布：<code>.prob 2d6+3</code> 或 <code>.prob 1d20+5 &gt;= 15</code>',
+    Text.PROBABILITY_RESULT: '<code>{expression}</code> 的概率分布\n\n'
+                             '范围：<code>{minimum} ~ {maximum}</code>\n'
+                             '平均值：<code>{mean:.2f}</code>\n'
+                             '分位数 (5% / 25% / 50% / 75% / 95%)：<code>{percentiles}</code>',
+    Text.PROBABILITY_TARGET: '不小于 {target} 的概率：<code>{probability:.2%}</code>',
+    Text.DICE_BUDGET_EXCEEDED: '骰子太多了，请减少骰子的数量或稍后再试',
+    Text.SIMULATION_USAGE: '模拟检定：<code>.sim 60</code>，奖励骰 <code>.sim+ 2 60</code>，'
+                           '惩罚骰 <code>.sim- 60</code>，或者 <code>.sim 2d6+3 &gt;= 10</code>',
+    Text.SIMULATION_BUSY: '模拟太频繁了，请稍后再试',
+    Text.SIMULATION_RESULT: '<code>{description}</code> 模拟了 {trials} 次\n',
+    Text.SIMULATION_LEVEL: '{level}：<code>{frequency:.1%} ± {error:.1%}</code>',
 }
 
 
@@ -368,6 +390,19 @@ zh_hant: Dict[Text, str] = {
     Text.INIT_USAGE: '用法： <code>.init [數字]</code> 或 <code>.init [角色名] = [數字]</code>',
     Text.INIT_WITHOUT_ROUND: '請先用 /round 指令開啓回合輪',
     Text.TIMER_SYNTAX_ERROR: '創建定時器：<code>.timer [秒數] [描述]</code>',
+    Text.PROBABILITY_TOO_COMPLEX: '表達式太複雜，無法計算概率分佈',
+    Text.PROBABILITY_USAGE: '計算概率分佈：<code>.prob 2d6+3</code> 或 <code>.prob 1d20+5 &gt;= 15</code>',
+    Text.PROBABILITY_RESULT: '<code>{expression}</code> 的概率分佈\n\n'
+                             '範圍：<code>{minimum} ~ {maximum}</code>\n'
+                             '平均值：<code>{mean:.2f}</code>\n'
+                             '分位數 (5% / 25% / 50% / 75% / 95%)：<code>{percentiles}</code>',
+    Text.PROBABILITY_TARGET: '不小於 {target} 的概率：<code>{probability:.2%}</code>',
+    Text.DICE_BUDGET_EXCEEDED: '骰子太多了，請減少骰子的數量或稍後再試',
+    Text.SIMULATION_USAGE: '模擬檢定：<code>.sim 60</code>，獎勵骰 <code>.sim+ 2 60</code>，'
+                           '懲罰骰 <code>.sim- 60</code>，或者 <code>.sim 2d6+3 &gt;= 10</code>',
+    Text.SIMULATION_BUSY: '模擬太頻繁了，請稍後再試',
+    Text.SIMULATION_RESULT: '<code>{description}</code> 模擬了 {trials} 次\n',
+    Text.SIMULATION_LEVEL: '{level}：<code>{frequency:.1%} ± {error:.1%}</code>',
 }
 
 default_text = zh_hans
@@ -0,0 +1,72 @@
+"""
+In-process counters of the bot for monitoring, served as JSON on their own listener in polling and webhook mode.
+"""
+import json
+import logging
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PATH = '/metrics'
+
+lock = threading.Lock()
+counters = Counter()
+gauges: Dict[str, Callable[[], int]] = {}
+
+
+def incr(name: str, value=1):
+    with lock:
+        counters[name] += value
+
+
+def gauge(name: str, read: Callable[[], int]):
+    """
+    A value read when the snapshot is taken, e.g. the length of a queue.
+    """
+    with lock:
+        gauges[name] = read
+
+
+def snapshot() -> Dict[str, int]:
+    with lock:
+        result = dict(counters)
+        reads = list(gauges.items())
+    for name, read in reads:
+        result[name] = read()
+    return result
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != PATH:
+            body = b''
+            self.send_response(404)
+        else:
+            body = json.dumps(snapshot()).encode()
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def serve(host: str, port: int) -> Optional[MetricsServer]:
+    """
+    Serve the snapshot on a thread, `None` if the port is 0. Bound to localhost by default, it is not for the public.
+    """
+    if not port:
+        return None
+    server = MetricsServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on %s:%d%s', host, port, PATH)
+    return server
@@ -1,5 +1,5 @@
 import re
-from typing import Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 
 # name = 42
 INITIATIVE_REGEX = re.compile(r'^(.+)=\s*(\d{1,4})$')
@@ -24,11 +24,30 @@ VARIABLE_MODIFY_REGEX = re.compile(r'^\s*[$¥]?([\w_0-9]{1,32})\s*([+\-])\s*')
 
 VARIABLE_IGNORE_HEAD = re.compile(r'^\s*=\s*')
 
-
-def split(patterns, text: str) -> Optional[Tuple[str, int]]:
-    result = re.match(patterns, text.lower())
-    if result is None:
-        return None
-    else:
-        command = result.group(1)
-        return command, result.end()
+# 1d20+5 >= 15
+PROBABILITY_TARGET_REGEX = re.compile(r'(?:>=|≥|＞＝)\s*(-?\d{1,6})')
+
+
+class Dispatcher:
+    """
+    The command patterns joined into one alternation, the text is lowercased and matched once.
+
+    The alternatives are tried in order, so the handler is the same as matching the patterns one by one.
+    """
+
+    def __init__(self, handlers: List[Tuple[re.Pattern, Callable]]):
+        self.handlers = []
+        alternatives = []
+        for pattern, handler in handlers:
+            # the group of the matched alternative tells the handler
+            assert pattern.groups == 1 and not pattern.groupindex, pattern.pattern
+            alternatives.append('(?:{})'.format(pattern.pattern))
+            self.handlers.append(handler)
+        self.regex = re.compile('|'.join(alternatives))
+
+    def match(self, text: str) -> Optional[Tuple[Callable, str, int]]:
+        result = self.regex.match(text.lower())
+        if result is None:
+            return None
+        index = result.lastindex
+        return self.handlers[index - 1], result.group(index), result.end()
@@ -1,19 +1,27 @@
 import re
-import secrets
+import time
 from functools import partial
+from typing import Optional
 
 import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext, JobQueue
+from django.conf import settings
+from django.core.cache import cache
 
 import dice
-from entities import RollResult, Span, CocResult, LoopResult, Entities
+import roller
+import probability
+import simulation
+from entities import RollResult, Span, CocResult, LoopResult, Entities, escape
+from archive import distributions
 from archive.models import LogKind, Log, Chat
-from .patterns import LOOP_ROLL_REGEX
-from .system import RpgMessage, get_chat, HideRoll, \
+from .patterns import LOOP_ROLL_REGEX, PROBABILITY_TARGET_REGEX
+from .system import RpgMessage, Roster, get_chat, HideRoll, \
     is_gm
-from bot.tasks import send_message, delete_message, error_message
+from bot.tasks import send_message, delete_message, error_message, answer_callback_query, outbox, REPLY
 from .display import Text, get_by_user
+from . import metrics
 
 
 def set_dice_face(update, context: CallbackContext):
@@ -35,7 +43,8 @@ def handle_set_dice_face(message: telegram.Message, text: str, job_queue, **_kwa
     send_message(job_queue, message.chat_id, _(Text.DEFAULT_FACE_SETTLED).format(face))
 
 
-def handle_coc_roll(message: telegram.Message, command: str, name: str, text: str, chat: Chat, job_queue, **__):
+def handle_coc_roll(message: telegram.Message, command: str, name: str, text: str, chat: Chat, job_queue,
+                    roster=None, **__):
     """
     Call of Cthulhu
     """
@@ -43,7 +52,7 @@ def handle_coc_roll(message: telegram.Message, command: str, name: str, text: st
         return get_by_user(t, user=message.from_user)
 
     def roll() -> int:
-        return secrets.randbelow(100) + 1
+        return roller.randint(100)
 
     hide = command[-1] == 'h'
     text = text.strip()
@@ -56,7 +65,8 @@ def handle_coc_roll(message: telegram.Message, command: str, name: str, text: st
 
     # have not target value
     if len(numbers) == 0:
-        handle_roll(job_queue, message, name, Entities([Span(text), RollResult(str(rolled), rolled)]), chat, hide)
+        entities = Entities([Span(text), RollResult(str(rolled), rolled)])
+        handle_roll(job_queue, message, name, entities, chat, hide, roster)
         return
 
     skill_number = int(numbers[0])
@@ -77,29 +87,40 @@ def handle_coc_roll(message: telegram.Message, command: str, name: str, text: st
             rolled = max(rolled_list)
             modifier_name = _(Text.COC_PENALTY_DIE)
 
-    half_skill_number = skill_number // 2
-    skill_number_divide_5 = skill_number // 5
+    level = _(coc_level(rolled, skill_number))
+    entities = [Span(text), Span(' → '), CocResult(rolled, level, modifier_name, rolled_list)]
+    handle_roll(job_queue, message, name, Entities(entities), chat, hide, roster)
+
 
+def coc_level(rolled: int, skill_number: int) -> Text:
     if rolled == 1:
-        level = _(Text.COC_CRITICAL)
-    elif rolled <= skill_number_divide_5:
-        level = _(Text.COC_EXTREME_SUCCESS)
-    elif rolled <= half_skill_number:
-        level = _(Text.COC_HARD_SUCCESS)
+        return Text.COC_CRITICAL
+    elif rolled <= skill_number // 5:
+        return Text.COC_EXTREME_SUCCESS
+    elif rolled <= skill_number // 2:
+        return Text.COC_HARD_SUCCESS
     elif rolled <= skill_number:
-        level = _(Text.COC_REGULAR_SUCCESS)
+        return Text.COC_REGULAR_SUCCESS
     elif rolled == 100:
-        level = _(Text.COC_FUMBLE)
+        return Text.COC_FUMBLE
     elif rolled >= 95 and skill_number < 50:
-        level = _(Text.COC_FUMBLE)
+        return Text.COC_FUMBLE
     else:
-        level = _(Text.COC_FAIL)
+        return Text.COC_FAIL
 
-    entities = [Span(text), Span(' → '), CocResult(rolled, level, modifier_name, rolled_list)]
-    handle_roll(job_queue, message, name, Entities(entities), chat, hide)
+
+COC_LEVELS = (
+    Text.COC_CRITICAL,
+    Text.COC_EXTREME_SUCCESS,
+    Text.COC_HARD_SUCCESS,
+    Text.COC_REGULAR_SUCCESS,
+    Text.COC_FAIL,
+    Text.COC_FUMBLE,
+)
 
 
-def handle_loop_roll(message: telegram.Message, command: str, name: str, text: str, chat: Chat, job_queue, **__):
+def handle_loop_roll(message: telegram.Message, command: str, name: str, text: str, chat: Chat, job_queue,
+                     roster=None, **__):
     """
     Tales from the Loop
     """
@@ -114,22 +135,48 @@ def handle_loop_roll(message: telegram.Message, command: str, name: str, text: s
     number = int(roll_match.group(1))
     if number == 0:
         return error_message(job_queue, message, _(Text.LOOP_ZERO_DICE))
-    result_list = [secrets.randbelow(6) + 1 for _i in range(number)]
+    result_list = roller.roll(6, number)
     description = text[roll_match.end():]
     entities = Entities([LoopResult(result_list), Span(description)])
-    handle_roll(job_queue, message, name, entities, chat, hide)
+    handle_roll(job_queue, message, name, entities, chat, hide, roster)
+
+
+def dice_budget_key(chat_id) -> str:
+    return 'dice_budget:{}'.format(chat_id)
+
 
+def get_dice_budget(chat_id) -> dice.Budget:
+    spent = cache.get(dice_budget_key(chat_id), 0)
+    return dice.Budget(min(settings.DICE_MESSAGE_BUDGET, settings.DICE_CHAT_BUDGET - spent))
 
-def handle_normal_roll(message: telegram.Message, command: str, name: str, start: int, chat: Chat, job_queue, **_):
-    rpg_message = RpgMessage(message, start)
+
+def add_in_window(key: str, value: int, window: int):
+    cache.add(key, 0, window)
+    try:
+        cache.incr(key, value)
+    except ValueError:
+        # expired in the meantime
+        cache.set(key, value, window)
+
+
+def spend_dice_budget(chat_id, budget: dice.Budget):
+    if budget.spent == 0:
+        return
+    add_in_window(dice_budget_key(chat_id), budget.spent, settings.DICE_CHAT_BUDGET_WINDOW)
+
+
+def handle_normal_roll(message: telegram.Message, command: str, name: str, start: int, chat: Chat, job_queue,
+                       roster=None, **_):
+    rpg_message = RpgMessage(message, start, roster=roster)
     hide = command[-1] == 'h'
     entities = rpg_message.entities.list
     roll_counter = 0
     next_entities = []
+    budget = get_dice_budget(chat.chat_id)
     try:
         for entity in entities:
             if isinstance(entity, Span):
-                result_entities = dice.roll_entities(entity.value, chat.default_dice_face)
+                result_entities = dice.roll_entities(entity.value, chat.default_dice_face, budget=budget)
                 local_roll_counter = 0
                 for result_entity in result_entities:
                     if isinstance(result_entity, RollResult):
@@ -142,22 +189,155 @@ def handle_normal_roll(message: telegram.Message, command: str, name: str, start
             else:
                 next_entities.append(entity)
         if roll_counter == 0:
-            default_roll_entities = dice.roll_entities('1d', chat.default_dice_face)
+            default_roll_entities = dice.roll_entities('1d', chat.default_dice_face, budget=budget)
             default_roll_entities.extend(next_entities)
             next_entities = default_roll_entities
     except dice.RollError as e:
-        error_text = Text.ERROR
-        if len(e.args) > 0:
-            error_kind = e.args[0]
-            try:
-                error_text = Text[error_kind.value]
-            except KeyError:
-                pass
-        return error_message(job_queue, message, get_by_user(error_text, message.from_user))
-    handle_roll(job_queue, message, name, Entities(next_entities), chat, hide)
-
-
-def handle_roll(job_queue: JobQueue, message: telegram.Message, name: str, entities: Entities, chat: Chat, hide=False):
+        return roll_error(job_queue, message, e)
+    finally:
+        spend_dice_budget(chat.chat_id, budget)
+    handle_roll(job_queue, message, name, Entities(next_entities), chat, hide, rpg_message.roster)
+
+
+def roll_error(job_queue, message: telegram.Message, e: dice.RollError):
+    error_text = Text.ERROR
+    if len(e.args) > 0:
+        error_kind = e.args[0]
+        metrics.incr('dice.error.{}'.format(error_kind.value))
+        try:
+            error_text = Text[error_kind.value]
+        except KeyError:
+            pass
+    return error_message(job_queue, message, get_by_user(error_text, message.from_user))
+
+
+PERCENTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def handle_probability(message: telegram.Message, text: str, chat: Chat, job_queue, **_):
+    _ = partial(get_by_user, user=message.from_user)
+    target = None
+    target_match = PROBABILITY_TARGET_REGEX.search(text)
+    if target_match:
+        target = int(target_match.group(1))
+        text = text[:target_match.start()]
+    expression = text.strip()
+    # the exact distribution shares the CPU time of the chat with `.sim`
+    if get_simulation_time(chat.chat_id) <= 0:
+        return error_message(job_queue, message, _(Text.SIMULATION_BUSY))
+    start = time.thread_time()
+    try:
+        distribution = probability.expression_distribution(expression, chat.default_dice_face)
+    except dice.RollError as e:
+        return roll_error(job_queue, message, e)
+    finally:
+        add_in_window(
+            simulation_time_key(chat.chat_id),
+            int((time.thread_time() - start) * 1000) + 1,
+            settings.SIMULATION_CHAT_CPU_WINDOW,
+        )
+    if distribution is None:
+        return error_message(job_queue, message, _(Text.PROBABILITY_USAGE))
+    send_text = _(Text.PROBABILITY_RESULT).format(
+        expression=escape(expression),
+        minimum=distribution.minimum,
+        maximum=distribution.maximum,
+        mean=distribution.mean(),
+        percentiles=' / '.join(str(distribution.percentile(p)) for p in PERCENTILES),
+    )
+    if target is not None:
+        send_text += '\n' + _(Text.PROBABILITY_TARGET).format(target=target, probability=distribution.at_least(target))
+    send_message(job_queue, message.chat_id, send_text, delete_after=60)
+    delete_message(job_queue, message.chat_id, message.message_id)
+
+
+def simulation_time_key(chat_id) -> str:
+    return 'simulation_time:{}'.format(chat_id)
+
+
+def get_simulation_time(chat_id) -> float:
+    """
+    CPU seconds a simulation of this chat may take now.
+    """
+    spent = cache.get(simulation_time_key(chat_id), 0) / 1000
+    return min(settings.SIMULATION_MESSAGE_CPU_TIME, settings.SIMULATION_CHAT_CPU_TIME - spent)
+
+
+def coc_sample(skill_number: int, extra: int, pick):
+    def sample(n: int):
+        rolled_list = roller.roll(100, n * (extra + 1))
+        step = extra + 1
+        return [coc_level(pick(rolled_list[i:i + step]), skill_number) for i in range(0, len(rolled_list), step)]
+    return sample
+
+
+def expression_sample(item, env: dice.Env, target: int):
+    def sample(n: int):
+        return [Text.COC_REGULAR_SUCCESS if item.eval(env)[0] >= target else Text.COC_FAIL for _ in range(n)]
+    return sample
+
+
+def handle_simulation(message: telegram.Message, command: str, text: str, chat: Chat, job_queue, **_):
+    _ = partial(get_by_user, user=message.from_user)
+    description = '{} {}'.format(command, text.strip())
+    target_match = PROBABILITY_TARGET_REGEX.search(text)
+    if target_match:
+        env = dice.Env(face=chat.default_dice_face)
+        items = [x for x in dice.parse_roll(text[:target_match.start()]) if not isinstance(x, str)]
+        if len(items) == 0:
+            return error_message(job_queue, message, _(Text.SIMULATION_USAGE))
+        item = items[0]
+        if isinstance(item, dice.Repeat):
+            item = item.expr
+        cost = item.cost(env)
+        if cost > settings.DICE_MESSAGE_BUDGET:
+            return roll_error(job_queue, message, dice.RollError(dice.DiceErrorKind.DICE_BUDGET_EXCEEDED))
+        sample = expression_sample(item, env, int(target_match.group(1)))
+        # a chunk rolls about as many dice as one message may
+        chunk = max(1, min(simulation.CHUNK, settings.DICE_MESSAGE_BUDGET // max(cost, 1)))
+        levels = (Text.COC_REGULAR_SUCCESS, Text.COC_FAIL)
+    else:
+        numbers = re.findall(r'\d{1,2}', text)
+        if len(numbers) == 0:
+            return error_message(job_queue, message, _(Text.SIMULATION_USAGE))
+        skill_number = int(numbers[0])
+        extra = 0
+        pick = min
+        if command[-1] in '+-':
+            extra = 1
+            if len(numbers) > 1:
+                extra = int(numbers[0])
+                skill_number = int(numbers[1])
+            pick = min if command[-1] == '+' else max
+        sample = coc_sample(skill_number, extra, pick)
+        chunk = simulation.CHUNK
+        levels = COC_LEVELS
+    cpu_time = get_simulation_time(chat.chat_id)
+    if cpu_time <= 0:
+        return error_message(job_queue, message, _(Text.SIMULATION_BUSY))
+    try:
+        result = simulation.simulate(sample, cpu_time, chunk=chunk)
+    except dice.RollError as e:
+        return roll_error(job_queue, message, e)
+    add_in_window(
+        simulation_time_key(chat.chat_id),
+        int(result.cpu_time * 1000) + 1,
+        settings.SIMULATION_CHAT_CPU_WINDOW,
+    )
+    metrics.incr('simulation.trials', result.trials)
+    lines = [_(Text.SIMULATION_RESULT).format(description=escape(description), trials=result.trials)]
+    for level in levels:
+        lines.append(_(Text.SIMULATION_LEVEL).format(
+            level=_(level),
+            frequency=result.frequency(level),
+            error=result.error(level),
+        ))
+    send_message(job_queue, message.chat_id, '\n'.join(lines), delete_after=60)
+    delete_message(job_queue, message.chat_id, message.message_id)
+
+
+def handle_roll(job_queue: JobQueue, message: telegram.Message, name: str, entities: Entities, chat: Chat, hide=False,
+                roster: Optional[Roster] = None):
     _ = partial(get_by_user, user=message.from_user)
     kind = LogKind.ROLL.value
     result_text = entities.telegram_html()
@@ -174,46 +354,42 @@ def handle_roll(job_queue: JobQueue, message: telegram.Message, name: str, entit
         reply_markup = None
     if not chat.recording:
         text = '[{}] '.format(_(Text.NOT_RECORDING)) + text
-    sent = message.chat.send_message(
-        text,
-        reply_markup=reply_markup,
-        parse_mode='HTML'
-    )
+    send = partial(message.chat.send_message, text, reply_markup=reply_markup, parse_mode='HTML')
+    sent = outbox.call(message.chat_id, REPLY, send, send=True)
     user = message.from_user
     assert isinstance(user, telegram.User)
     if chat.recording:
+        gm = roster.is_gm(user.id) if roster is not None else is_gm(message.chat_id, user.id)
         Log.objects.create(
             user_id=user.id,
             message_id=sent.message_id,
             chat=chat,
             content=result_text,
-            entities=entities.to_object(),
             user_fullname=user.full_name,
             character_name=name,
-            gm=is_gm(message.chat_id, user.id),
+            gm=gm,
             kind=kind,
             created=message.date,
+            **Log.encode_entities(entities),
         )
-        chat.save()
+        chat.touch()
+        # after the reply is sent, so the archive can tell how lucky the rolls were
+        for entity in entities.list:
+            if isinstance(entity, RollResult) and entity.expression:
+                distributions.request_ranks(entity.expression)
     delete_message(job_queue, message.chat_id, message.message_id, 25)
 
 
-def hide_roll_callback(_, update):
-    query = update.callback_query
-    assert isinstance(query, telegram.CallbackQuery)
+def hide_roll_callback(job_queue: JobQueue, query: telegram.CallbackQuery):
     _ = partial(get_by_user, user=query.from_user)
     gm = is_gm(query.message.chat_id, query.from_user.id)
     key = query.data
     if not gm:
-        query.answer(_(Text.ONLY_GM_CAN_LOOKUP), show_alert=True)
+        answer_callback_query(job_queue, query.id, _(Text.ONLY_GM_CAN_LOOKUP), show_alert=True)
         return
     hide_roll = HideRoll.get(key)
     if hide_roll:
         text = hide_roll.text
     else:
         text = _(Text.HIDE_ROLL_NOT_FOUND)
-    query.answer(
-        show_alert=True,
-        text=text,
-        cache_time=10000,
-    )
+    answer_callback_query(job_queue, query.id, text, show_alert=True, cache_time=10000)
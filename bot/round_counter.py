@@ -5,7 +5,8 @@ import telegram
 from django.db import transaction
 from telegram.ext import JobQueue, CallbackContext
 
-from bot.tasks import update_round_message_task, answer_callback_query, edit_message, error_message, delete_message
+from bot.tasks import update_round_message_task, answer_callback_query, edit_message, error_message, delete_message, \
+    outbox, EDIT, REPLY
 from .system import NotGm, is_group_chat, is_gm, bot
 from .patterns import INITIATIVE_REGEX
 from game.models import Round, Player, Actor
@@ -54,7 +55,7 @@ def round_inline_handle(_bot: telegram.Bot, job_queue: JobQueue, query: telegram
             answer_callback_query(job_queue, query.id)
             update_round_message(job_queue, game_round, language_code, refresh=True)
         else:
-            answer_callback_query(query.id, _(Text.AT_LEAST_ONE_ACTOR), show_alert=True)
+            answer_callback_query(job_queue, query.id, _(Text.AT_LEAST_ONE_ACTOR), show_alert=True)
     elif method == 'round:finish':
         if not gm:
             raise NotGm()
@@ -87,7 +88,10 @@ def remove_round(job_queue: JobQueue, chat_id):
 
 
 def update_round_message(job_queue: JobQueue, game_round: Round, language_code, refresh=False):
-    job_queue.run_once(lambda _: update_round_message_task(game_round.chat_id, language_code, refresh), 0)
+    # a delete and a send when the message is not refreshed
+    cost = 1 if refresh else 2
+    outbox.submit(game_round.chat_id, EDIT, update_round_message_task, game_round.chat_id, language_code, refresh,
+                  cost=cost, send=not refresh)
 
 
 def handle_start_round(message: telegram.Message, job_queue, **_kwargs):
@@ -98,7 +102,7 @@ def handle_start_round(message: telegram.Message, job_queue, **_kwargs):
     text = '{} #round\n\n\n{}'.format(_(Text.ROUND_INDICATOR), _(Text.ROUND_INDICATOR_INIT))
     delete_message(job_queue, message.chat_id, message.message_id)
 
-    sent = chat.send_message(text, parse_mode='HTML')
+    sent = outbox.call(chat.id, REPLY, partial(chat.send_message, text, parse_mode='HTML'), send=True)
 
     message_id = sent.message_id
     chat_id = sent.chat_id
@@ -1,20 +1,21 @@
 from functools import partial
+from typing import Optional
 
 import telegram
 from telegram.ext import JobQueue
 
 from bot.tasks import edit_message, edit_message_photo, edit_message_caption, delete_message, \
-    error_message, set_photo
+    error_message, set_photo, outbox, REPLY
 from archive.models import LogKind, Log, Tag, Chat
 from . import display, patterns
 from .character_name import set_temp_name, get_temp_name
-from .system import RpgMessage, is_gm, bot
+from .system import RpgMessage, Roster, bot
 from .display import Text, get_by_user
 
 
-def get_symbol(chat_id, user_id) -> str:
+def get_symbol(gm: bool) -> str:
     symbol = ''
-    if is_gm(chat_id, user_id):
+    if gm:
         symbol = display.GM_SYMBOL
     return symbol + ' '
 
@@ -24,7 +25,7 @@ def is_empty_message(text):
 
 
 def handle_as_say(chat, job_queue: JobQueue, message: telegram.Message, start: int, name: str, with_photo=None,
-                  edit_log=None, **_):
+                  edit_log=None, roster=None, **_):
     user_id = message.from_user.id
 
     _ = partial(get_by_user, user=message.from_user)
@@ -36,13 +37,13 @@ def handle_as_say(chat, job_queue: JobQueue, message: telegram.Message, start: i
             return error_message(job_queue, message, _(Text.EMPTY_NAME))
         set_temp_name(chat.chat_id, user_id, temp_name)
         handle_say(job_queue, chat, message, temp_name, edit_log=edit_log, with_photo=with_photo,
-                   start=match.end(), temp_name=temp_name)
+                   start=match.end(), temp_name=temp_name, roster=roster)
     else:
         temp_name = get_temp_name(chat.chat_id, user_id) or ''
         if temp_name == '':
             return error_message(job_queue, message, _(Text.AS_SYNTAX_ERROR))
         handle_say(job_queue, chat, message, name, edit_log=edit_log, with_photo=with_photo,
-                   start=start, temp_name=temp_name)
+                   start=start, temp_name=temp_name, roster=roster)
 
 
 def get_tag(chat: Chat, name: str):
@@ -51,11 +52,11 @@ def get_tag(chat: Chat, name: str):
 
 
 def handle_say(job_queue: JobQueue, chat: Chat, message: telegram.Message, name: str, edit_log=None,
-               with_photo=None, temp_name=None, start=0):
+               with_photo=None, temp_name=None, start=0, roster: Optional[Roster] = None):
     _ = partial(get_by_user, user=message.from_user)
-    rpg_message = RpgMessage(message, start, temp_name)
+    rpg_message = RpgMessage(message, start, temp_name, roster)
     user_id = message.from_user.id
-    gm = is_gm(message.chat_id, user_id)
+    gm = rpg_message.roster.is_gm(user_id)
 
     kind = LogKind.NORMAL.value
 
@@ -70,7 +71,7 @@ def handle_say(job_queue: JobQueue, chat: Chat, message: telegram.Message, name:
         send_text = text
     else:
         send_text = '<b>{}</b>: {}'.format(temp_name or name, text)
-    symbol = get_symbol(message.chat_id, user_id)
+    symbol = get_symbol(gm)
     send_text = symbol + send_text
 
     if isinstance(edit_log, Log):
@@ -97,18 +98,21 @@ def send_and_record(job_queue: JobQueue, chat, gm, kind, message: telegram.Messa
         reply_to_message_id = reply_log.message_id
     # send message
     if isinstance(with_photo, telegram.PhotoSize):
-        sent = message.chat.send_photo(
+        send = partial(
+            message.chat.send_photo,
             photo=with_photo,
             caption=send_text,
             reply_to_message_id=reply_to_message_id,
             parse_mode='HTML',
         )
     else:
-        sent = message.chat.send_message(
+        send = partial(
+            message.chat.send_message,
             send_text,
             reply_to_message_id=reply_to_message_id,
             parse_mode='HTML',
         )
+    sent = outbox.call(message.chat_id, REPLY, send, send=True)
     if not chat.recording:
         return
     # record log
@@ -120,21 +124,20 @@ def send_and_record(job_queue: JobQueue, chat, gm, kind, message: telegram.Messa
         user_fullname=message.from_user.full_name,
         kind=kind,
         reply=reply_log,
-        entities=rpg_message.entities.to_object(),
         character_name=name,
         temp_character_name=temp_name or '',
         content=content,
         gm=gm,
         created=message.date,
+        **Log.encode_entities(rpg_message.entities),
     )
     for name in rpg_message.tags:
         created_log.tag.add(get_tag(chat, name))
-    created_log.save()
     # download and write photo file
     if with_photo:
         set_photo(job_queue, created_log.id, with_photo.file_id)
     delete_message(job_queue, message.chat_id, message.message_id, 10)
-    chat.save()
+    chat.touch()
 
 
 def on_edit(job_queue: JobQueue, chat: Chat, edit_log: Log, kind, message, rpg_message: RpgMessage, send_text, text,
@@ -154,9 +157,9 @@ def on_edit(job_queue: JobQueue, chat: Chat, edit_log: Log, kind, message, rpg_m
         tag = get_tag(chat, tag_name)
         edit_log.tag.add(tag)
     edit_log.content = text
-    edit_log.entities = rpg_message.entities.to_object()
+    edit_log.set_entities(rpg_message.entities)
     edit_log.kind = kind
     edit_log.save()
     delete_message(job_queue, message.chat_id, message.message_id, 25)
-    chat.save()
+    chat.touch()
     return
@@ -1,5 +1,5 @@
 import re
-from typing import Optional, List
+from typing import Dict, Optional, List
 from uuid import uuid4
 
 import telegram
@@ -7,6 +7,7 @@ from telegram import Bot
 from telegram.ext import JobQueue
 from django.conf import settings
 from django.core.cache import cache
+from django.utils.functional import cached_property
 
 from archive.models import Chat, Log
 
@@ -14,13 +15,18 @@ from entities import Me, Bold, Character, Span, Entities, Entity
 from .patterns import ME_REGEX, VARIABLE_REGEX
 from game.models import Player, Variable
 
-bot = Bot(settings.BOT_TOKEN)
+bot = Bot(settings.BOT_TOKEN, base_url=settings.BOT_API_URL)
+
+# `deleteMessages` takes at most 100 messages of a chat
+BULK_DELETE_LIMIT = 100
+# false after the API server told it does not have `deleteMessages`
+bulk_delete = True
 
 
 class Context:
     def __init__(self, bot_: telegram.Bot, chat: Chat, player: Player, command: str, name: str, start: int,
                  text: str, message: telegram.Message, job_queue: JobQueue, language_code: str,
-                 with_photo: Optional[telegram.PhotoSize], edit_log: Optional[Log]):
+                 with_photo: Optional[telegram.PhotoSize], edit_log: Optional[Log], roster: Optional['Roster'] = None):
         self.bot = bot_
         self.chat = chat
         self.player = player
@@ -33,6 +39,7 @@ class Context:
         self.language_code = language_code
         self.with_photo = with_photo
         self.edit_log = edit_log
+        self.roster = roster
 
 
 class NotGm(Exception):
@@ -81,23 +88,83 @@ def get_player_by_id(chat_id, user_id) -> Optional[Player]:
     return Player.objects.filter(user_id=user_id, chat_id=chat_id).first()
 
 
+class Roster:
+    """
+    The players of a chat, queried once for an update and shared by its handlers.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.players: List[Player] = list(Player.objects.filter(chat_id=chat_id).order_by('id'))
+        self.by_user_id: Dict[int, Player] = {}
+        for player in self.players:
+            self.by_user_id.setdefault(player.user_id, player)
+        self._variables: Dict[int, Dict[str, str]] = {}
+
+    def get_player(self, user_id) -> Optional[Player]:
+        return self.by_user_id.get(user_id)
+
+    def is_gm(self, user_id) -> bool:
+        player = self.get_player(user_id)
+        return player is not None and player.is_gm
+
+    def variables(self, player: Player) -> Dict[str, str]:
+        """
+        Values by upper-cased names, queried the first time they are asked for.
+        """
+        variables = self._variables.get(player.id)
+        if variables is None:
+            variables = {}
+            for variable in player.variable_set.all():
+                variables[variable.name.upper()] = variable.value
+            self._variables[player.id] = variables
+        return variables
+
+
+def delete_one(chat_id, message_id):
+    try:
+        bot.delete_message(chat_id, message_id)
+    except telegram.error.BadRequest:
+        pass
+
+
+def delete_messages(chat_id, message_ids: List[int]) -> List[int]:
+    """
+    Delete with `deleteMessages`, the messages it did not delete are returned to be deleted one by one.
+    """
+    global bulk_delete
+    rest = []
+    for start in range(0, len(message_ids), BULK_DELETE_LIMIT):
+        chunk = message_ids[start:start + BULK_DELETE_LIMIT]
+        if bulk_delete:
+            url = '{}/deleteMessages'.format(bot.base_url)
+            try:
+                bot.request.post(url, {'chat_id': chat_id, 'message_ids': chunk})
+                continue
+            except telegram.error.InvalidToken:
+                # 404, the method is not found
+                bulk_delete = False
+            except telegram.error.BadRequest:
+                pass
+        rest.extend(chunk)
+    return rest
+
+
 class RpgMessage:
     me = None
-    variables = {}
+    player = None
     segments: List[Entity]
     entities: Entities
 
-    def __init__(self, message: telegram.Message, start=0, temp_name=None):
+    def __init__(self, message: telegram.Message, start=0, temp_name=None, roster: Optional[Roster] = None):
         self.entities = Entities()
         self.start = start
-        self.players = list(Player.objects.filter(chat_id=message.chat_id).all())
-        for player in self.players:
-            if player.user_id == message.from_user.id:
-                self.me = Me(temp_name or player.character_name, player.id, player.full_name)
-                self.variables = {}
-                for variable in player.variable_set.all():
-                    self.variables[variable.name.upper()] = variable.value
-                break
+        self.roster = roster or Roster(message.chat_id)
+        self.players = self.roster.players
+        player = self.roster.get_player(message.from_user.id)
+        if player is not None:
+            self.player = player
+            self.me = Me(temp_name or player.character_name, player.id, player.full_name)
 
         self.tags = []
         if message.caption:
@@ -142,6 +209,13 @@ class RpgMessage:
             else:
                 self.entities.list.pop(0)
 
+    @cached_property
+    def variables(self) -> Dict[str, str]:
+        # only when the text names a variable
+        if self.player is None:
+            return {}
+        return self.roster.variables(self.player)
+
     def replace_variable(self, matched):
         return self.variables.get(matched.group(1).upper(), matched.group(0))
 
@@ -248,11 +322,11 @@ class Deletion:
         cache.set(key, self, self.expire_time)
 
     def do(self):
-        for message_id in self.message_list:
-            try:
-                bot.delete_message(self.chat_id, message_id)
-            except telegram.TelegramError:
-                pass
+        try:
+            for message_id in delete_messages(self.chat_id, self.message_list):
+                delete_one(self.chat_id, message_id)
+        except telegram.TelegramError:
+            pass
         Log.objects.filter(chat__chat_id=self.chat_id, message_id__in=self.message_list).delete()
         if self.variable_id_list:
             Variable.objects.filter(id__in=self.variable_id_list).delete()
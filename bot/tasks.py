@@ -1,8 +1,14 @@
 import io
+import heapq
+import itertools
+import threading
+import time
 import uuid
 import logging
 import base64
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import telegram
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, TelegramError
@@ -10,13 +16,403 @@ from telegram.ext import JobQueue, CallbackContext
 from django.core.cache import cache
 
 from archive.models import Log
+from bot import metrics, system
 from bot.display import get, Text, get_by_user
-from bot.system import bot
+from bot.system import bot, delete_messages, delete_one
 from game.models import Round
 from play_trpg.celery import app
 
 logger = logging.getLogger(__name__)
 
+# priorities of the outbox, the lower are sent first
+ANSWER = 0
+REPLY = 1
+EDIT = 2
+CLEANUP = 3
+
+# the limits of Telegram: 30 calls a second in all, one a second in a chat and 20 messages a minute in a group
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+GROUP_BURST = 5
+# calls made at once, e.g. photos uploaded to several chats
+OUTBOX_WORKERS = 8
+# after a network error, wait `RETRY_BACKOFF * 2 ** attempts` seconds
+RETRY_BACKOFF = 0.5
+MAX_ATTEMPTS = 5
+# seconds a handler waits for the message it sends, the call is cancelled if it is not made by then
+CALL_TIMEOUT = 60
+# the deletions of a chat due within this many seconds are sent in one batch
+DELETION_WINDOW = 1.0
+# more deletions are sent at once instead of waiting
+MAX_PENDING_DELETIONS = 10000
+
+
+def call_name(func: Callable) -> str:
+    if isinstance(func, partial):
+        func = func.func
+    return getattr(func, '__name__', repr(func))
+
+
+class TokenBucket:
+    """
+    `capacity` calls at once, then `rate` calls a second.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float, cost=1) -> float:
+        """
+        Seconds until `cost` tokens can be taken.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost=1):
+        self.tokens -= cost
+
+    def block(self, until: float):
+        """
+        Told by Telegram to wait, with `retry_after`.
+        """
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+
+
+def in_order(heap: list) -> Iterator:
+    """
+    The entries of a heap from the smallest, only as many as are taken are ordered.
+    """
+    frontier = [(heap[0], 0)] if heap else []
+    while frontier:
+        entry, i = heapq.heappop(frontier)
+        yield entry
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+
+
+class OutboxJob:
+    __slots__ = ('chat_id', 'priority', 'order', 'func', 'args', 'cost', 'send', 'attempts', 'not_before', 'delayed',
+                 'future')
+
+    def __init__(self, chat_id: Optional[int], priority: int, order: int, func: Callable, args: tuple, cost: int,
+                 send: bool):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.order = order
+        self.func = func
+        self.args = args
+        self.cost = cost
+        # sends a message, limited by the bucket of the group
+        self.send = send
+        self.attempts = 0
+        self.not_before = 0.0
+        self.delayed = False
+        self.future = Future()
+
+
+class Outbox:
+    """
+    Calls to the Bot API within the limits of Telegram, the most urgent first.
+
+    One thread picks the calls and a bounded pool makes them, so a slow upload holds one thread and not the other
+    chats. A chat has one call in flight at most, the calls of a chat with the same priority are made in order.
+    """
+
+    def __init__(self, max_workers=OUTBOX_WORKERS):
+        self.condition = threading.Condition()
+        self.queue: List[Tuple[int, int, OutboxJob]] = []
+        self.order = itertools.count()
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.group_buckets: Dict[int, TokenBucket] = {}
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='outbox')
+        # the calls in the pool, and their chats
+        self.in_flight = 0
+        self.busy_chats = set()
+        self.thread: Optional[threading.Thread] = None
+        metrics.gauge('outbox.queue_depth', lambda: len(self.queue))
+        metrics.gauge('outbox.in_flight', lambda: self.in_flight)
+
+    def submit(self, chat_id: Optional[int], priority: int, func: Callable, *args, cost=1, send=False) -> Future:
+        """
+        `chat_id` is None for the calls not limited in a chat, e.g. the answers of callback queries. `send` is true
+        for the calls which send a message, only those count against the limit of a group.
+        """
+        return self.enqueue(chat_id, priority, func, args, cost, send).future
+
+    def call(self, chat_id: Optional[int], priority: int, func: Callable, *args, send=False):
+        """
+        Submit and wait for the result, for the handlers which need the sent message.
+
+        Raises `TimeoutError` if the call is not made in `CALL_TIMEOUT` seconds, it is cancelled then so the handler
+        does not miss a message sent later. A call in flight can not be cancelled and is waited for.
+        """
+        job = self.enqueue(chat_id, priority, func, args, 1, send)
+        while True:
+            try:
+                return job.future.result(CALL_TIMEOUT)
+            except TimeoutError:
+                if self.cancel(job):
+                    metrics.incr('outbox.timeout')
+                    raise
+
+    def enqueue(self, chat_id: Optional[int], priority: int, func: Callable, args: tuple, cost: int,
+                send: bool) -> OutboxJob:
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+                self.thread.start()
+            job = OutboxJob(chat_id, priority, next(self.order), func, args, cost, send)
+            self.push(job)
+            self.condition.notify()
+        return job
+
+    def cancel(self, job: OutboxJob) -> bool:
+        """
+        Remove a job which is waiting, false if it is in flight or done.
+        """
+        with self.condition:
+            for entry in self.queue:
+                if entry[2] is job:
+                    self.remove(entry)
+                    job.future.cancel()
+                    return True
+        return False
+
+    def push(self, job: OutboxJob):
+        heapq.heappush(self.queue, (job.priority, job.order, job))
+
+    def remove(self, entry: Tuple[int, int, OutboxJob]):
+        last = self.queue.pop()
+        if last is not entry:
+            self.queue[self.queue.index(entry)] = last
+            heapq.heapify(self.queue)
+
+    @staticmethod
+    def get_bucket(buckets: Dict[int, TokenBucket], chat_id: int, rate: float, capacity: float) -> TokenBucket:
+        bucket = buckets.get(chat_id)
+        if bucket is None:
+            if len(buckets) > 10000:
+                # the chats not sent to for a while
+                now = time.monotonic()
+                for key in [key for key, b in buckets.items() if b.delay(now, b.capacity) == 0]:
+                    del buckets[key]
+            bucket = buckets[chat_id] = TokenBucket(rate, capacity)
+        return bucket
+
+    def job_buckets(self, job: OutboxJob) -> List[TokenBucket]:
+        if job.chat_id is None:
+            return []
+        buckets = [self.get_bucket(self.buckets, job.chat_id, CHAT_RATE, CHAT_BURST)]
+        if job.send and job.chat_id < 0:
+            buckets.append(self.get_bucket(self.group_buckets, job.chat_id, GROUP_RATE, GROUP_BURST))
+        return buckets
+
+    def next_job(self) -> OutboxJob:
+        # called with the condition held
+        while True:
+            now = time.monotonic()
+            wait = None
+            if self.queue and self.in_flight < self.max_workers:
+                wait = self.global_bucket.delay(now)
+            if wait == 0:
+                wait = None
+                # the chats and priorities with an earlier job waiting, the later jobs wait behind it
+                waiting = set()
+                for entry in in_order(self.queue):
+                    job = entry[2]
+                    if job.chat_id in self.busy_chats:
+                        # taken again when the call in flight is done
+                        continue
+                    if (job.chat_id, job.priority) in waiting:
+                        job.delayed = True
+                        continue
+                    buckets = self.job_buckets(job)
+                    job_wait = max([job.not_before - now] + [bucket.delay(now, job.cost) for bucket in buckets])
+                    if job_wait <= 0:
+                        self.remove(entry)
+                        self.global_bucket.take(job.cost)
+                        for bucket in buckets:
+                            bucket.take(job.cost)
+                        return job
+                    job.delayed = True
+                    if job.chat_id is not None:
+                        waiting.add((job.chat_id, job.priority))
+                    wait = job_wait if wait is None else min(wait, job_wait)
+            self.condition.wait(wait)
+
+    def run(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                self.in_flight += 1
+                if job.chat_id is not None:
+                    self.busy_chats.add(job.chat_id)
+            self.executor.submit(self.send, job)
+
+    def done(self, job: OutboxJob, retry_at: Optional[float] = None):
+        with self.condition:
+            # pushed again before the chat is free, so the next call of the chat can not overtake it
+            if retry_at is not None:
+                job.delayed = True
+                job.not_before = retry_at
+                self.push(job)
+            self.in_flight -= 1
+            self.busy_chats.discard(job.chat_id)
+            self.condition.notify()
+
+    def send(self, job: OutboxJob):
+        retry_at = None
+        try:
+            result = job.func(*job.args)
+        except telegram.error.RetryAfter as e:
+            metrics.incr('outbox.retry_after')
+            with self.condition:
+                for bucket in self.job_buckets(job):
+                    bucket.block(time.monotonic() + e.retry_after)
+            retry_at = self.retry(job, e.retry_after, e)
+        except telegram.error.BadRequest as e:
+            self.fail(job, e)
+        except telegram.error.TimedOut as e:
+            if job.send:
+                # the message may be sent already, sent again it would be a duplicate
+                self.fail(job, e)
+            else:
+                retry_at = self.retry(job, RETRY_BACKOFF * 2 ** job.attempts, e)
+        except telegram.error.NetworkError as e:
+            retry_at = self.retry(job, RETRY_BACKOFF * 2 ** job.attempts, e)
+        except Exception as e:
+            self.fail(job, e)
+        else:
+            if job.delayed:
+                metrics.incr('outbox.delayed')
+            metrics.incr('outbox.sent')
+            job.future.set_result(result)
+        finally:
+            self.done(job, retry_at)
+
+    def retry(self, job: OutboxJob, delay: float, error: Exception) -> Optional[float]:
+        """
+        When to make the call again, `None` if it is dropped.
+        """
+        job.attempts += 1
+        if job.attempts >= MAX_ATTEMPTS:
+            metrics.incr('outbox.dropped')
+            logger.warning('Dropped %s after %d attempts: %s', call_name(job.func), job.attempts, error)
+            job.future.set_exception(error)
+            return None
+        return time.monotonic() + delay
+
+    def fail(self, job: OutboxJob, error: Exception):
+        metrics.incr('outbox.failed')
+        if isinstance(error, TelegramError):
+            logger.warning('Error on %s: %s', call_name(job.func), error)
+        else:
+            logger.error('Error on %s', call_name(job.func), exc_info=error)
+        job.future.set_exception(error)
+
+
+outbox = Outbox()
+
+
+class Deletions:
+    """
+    The scheduled deletions by due time, a batch of each chat goes to the outbox when they are due.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # due time by (chat_id, message_id), entries of the heap with another time are outdated
+        self.due: Dict[Tuple[int, int], float] = {}
+        self.heap: List[Tuple[float, int, int]] = []
+        self.thread: Optional[threading.Thread] = None
+        metrics.gauge('deletions.pending', lambda: len(self.due))
+
+    def schedule(self, chat_id: int, message_id: int, when: float):
+        """
+        Scheduled again, a message is deleted at the new time.
+        """
+        key = (chat_id, message_id)
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='deletions', daemon=True)
+                self.thread.start()
+            if key not in self.due and len(self.due) >= MAX_PENDING_DELETIONS:
+                metrics.incr('deletions.overflow')
+                when = 0
+            due = time.monotonic() + when
+            self.due[key] = due
+            heapq.heappush(self.heap, (due, chat_id, message_id))
+            self.condition.notify()
+
+    def cancel(self, chat_id: int, message_id: int):
+        with self.condition:
+            self.due.pop((chat_id, message_id), None)
+
+    def next_batches(self) -> Dict[int, List[int]]:
+        # called with the condition held
+        while True:
+            heap = self.heap
+            while heap and self.due.get(heap[0][1:]) != heap[0][0]:
+                heapq.heappop(heap)
+            if not heap:
+                self.condition.wait()
+                continue
+            now = time.monotonic()
+            if heap[0][0] > now:
+                self.condition.wait(heap[0][0] - now)
+                continue
+            batches: Dict[int, List[int]] = {}
+            while heap and heap[0][0] <= now + DELETION_WINDOW:
+                due, chat_id, message_id = heapq.heappop(heap)
+                if self.due.get((chat_id, message_id)) == due:
+                    del self.due[(chat_id, message_id)]
+                    batches.setdefault(chat_id, []).append(message_id)
+            return batches
+
+    def run(self):
+        while True:
+            with self.condition:
+                batches = self.next_batches()
+            for chat_id, message_ids in batches.items():
+                metrics.incr('deletions.batches')
+                metrics.incr('deletions.messages', len(message_ids))
+                if not system.bulk_delete:
+                    for message_id in message_ids:
+                        outbox.submit(chat_id, CLEANUP, delete_one, chat_id, message_id)
+                    continue
+                # one call for each job, a retry never repeats the chunks deleted already
+                for start in range(0, len(message_ids), system.BULK_DELETE_LIMIT):
+                    chunk = message_ids[start:start + system.BULK_DELETE_LIMIT]
+                    outbox.submit(chat_id, CLEANUP, delete_chunk, chat_id, chunk)
+
+
+def delete_chunk(chat_id: int, message_ids: List[int]):
+    """
+    The messages `deleteMessages` did not delete go back to the outbox one by one, each under the limits and
+    retried alone.
+    """
+    for message_id in delete_messages(chat_id, message_ids):
+        outbox.submit(chat_id, CLEANUP, delete_one, chat_id, message_id)
+
+
+deletions = Deletions()
+
 
 def set_photo_task(log_id, file_id):
     log = Log.objects.get(id=log_id)
@@ -58,18 +454,16 @@ def send_timer_massage(context: CallbackContext):
     text = '{}秒倒计时结束'.format(timer)
     if len(comment) > 0:
         text += ': {}'.format(comment)
-    try:
-        bot.send_message(chat_id, text, reply_markup=reply_markup)
-    except telegram.error.BadRequest:
-        pass
+    outbox.submit(chat_id, REPLY, send_timer_message_task, chat_id, text, reply_markup, send=True)
+
+
+def send_timer_message_task(chat_id, text, reply_markup):
+    bot.send_message(chat_id, text, reply_markup=reply_markup)
 
 
 def send_message_task(job_queue, chat_id, text, reply_to=None, parse_mode='HTML', delete_after=None):
-    try:
-        sent = bot.send_message(chat_id, text, parse_mode, disable_web_page_preview=True, reply_to_message_id=reply_to)
-    except telegram.error.TelegramError:
-        logger.exception('Error on send message')
-        return
+    # errors are logged by the outbox
+    sent = bot.send_message(chat_id, text, parse_mode, disable_web_page_preview=True, reply_to_message_id=reply_to)
     if delete_after and delete_after > 0:
         delete_message(job_queue, chat_id, sent.message_id, delete_after)
 
@@ -147,26 +541,24 @@ def update_round_message_task(chat_id, language_code, refresh):
 
 
 def answer_callback_query(job_queue: JobQueue, query_id, text=None, show_alert=False, cache_time=0):
-    job_queue.run_once(lambda _: answer_callback_query_task(query_id, text, show_alert, cache_time), 0)
+    outbox.submit(None, ANSWER, answer_callback_query_task, query_id, text, show_alert, cache_time)
 
 
 def edit_message(job_queue: JobQueue, chat_id, message_id, text, parse_mode='HTML'):
-    job_queue.run_once(lambda _: edit_message_task(chat_id, message_id, text, parse_mode), 0)
+    outbox.submit(chat_id, EDIT, edit_message_task, chat_id, message_id, text, parse_mode)
 
 
 def edit_message_photo(job_queue: JobQueue, chat_id, message_id, media_id):
-    job_queue.run_once(lambda _: edit_message_photo_task(chat_id, message_id, media_id), 0)
+    outbox.submit(chat_id, EDIT, edit_message_photo_task, chat_id, message_id, media_id)
 
 
 def edit_message_caption(job_queue: JobQueue, chat_id, message_id, text, parse_mode='HTML'):
-    job_queue.run_once(lambda _: edit_message_caption_task(chat_id, message_id, text, parse_mode), 0)
+    outbox.submit(chat_id, EDIT, edit_message_caption_task, chat_id, message_id, text, parse_mode)
 
 
 def send_message(job_queue: JobQueue, chat_id, text, reply_to=None, parse_mode='HTML', delete_after=None):
-    job_queue.run_once(
-        lambda context: send_message_task(context.job_queue, chat_id, text, reply_to, parse_mode, delete_after),
-        0
-    )
+    outbox.submit(chat_id, REPLY, send_message_task, job_queue, chat_id, text, reply_to, parse_mode, delete_after,
+                  send=True)
 
 
 def deletion_task_key(chat_id, message_id):
@@ -174,12 +566,8 @@ def deletion_task_key(chat_id, message_id):
 
 
 def delete_message(job_queue: JobQueue, chat_id, message_id, when=0):
-    key = deletion_task_key(chat_id, message_id)
-    delete_tasks = job_queue.get_jobs_by_name(key)
-    for task in delete_tasks:
-        # Deletion will be postponed
-        task.schedule_removal()
-    job_queue.run_once(lambda _: delete_message_task(chat_id, message_id), when, name=key)
+    # scheduled again, the deletion will be postponed
+    deletions.schedule(chat_id, message_id, when)
 
 
 def timer_message(job_queue: JobQueue, chat_id, timer, comment):
@@ -191,6 +579,7 @@ def timer_message(job_queue: JobQueue, chat_id, timer, comment):
 
 
 def cancel_delete_message(chat_id, message_id):
+    deletions.cancel(chat_id, message_id)
     key = deletion_task_key(chat_id, message_id)
     task_id = cache.get(key)
     if not task_id:
@@ -200,7 +589,7 @@ def cancel_delete_message(chat_id, message_id):
 
 
 def after_edit_delete_previous_message(job_queue: JobQueue, log_id):
-    job_queue.run_once(lambda _: after_edit_delete_previous_message_task(log_id), 0)
+    outbox.submit(None, CLEANUP, after_edit_delete_previous_message_task, log_id)
 
 
 def error_message(job_queue: JobQueue, message: telegram.Message, text: str):
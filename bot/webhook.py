@@ -0,0 +1,112 @@
+"""
+Receive updates on a webhook instead of long polling, so the bot can run behind a load balancer.
+"""
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from urllib.parse import urlparse
+
+import telegram
+from telegram.ext import Updater
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# an update is a few kilobytes, larger bodies are refused
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: 'WebhookServer'
+
+    def do_POST(self):
+        if self.path != self.server.path:
+            return self.reply(404)
+        secret = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret.encode(), self.server.secret.encode()):
+            metrics.incr('webhook.forbidden')
+            return self.reply(403)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return self.reply(400)
+        if length < 0:
+            return self.reply(400)
+        if length > MAX_BODY_SIZE:
+            return self.reply(413)
+        try:
+            data = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.reply(400)
+        if not isinstance(data, dict):
+            return self.reply(400)
+        update = telegram.Update.de_json(data, self.server.bot)
+        self.server.update_queue.put(update)
+        metrics.incr('webhook.updates')
+        self.reply(200)
+
+    def reply(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Puts the updates into the queue of the dispatcher, the handlers run in the dispatcher as in polling.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, path: str, secret: str, bot: telegram.Bot, update_queue: Queue):
+        super().__init__(address, WebhookHandler)
+        self.path = path
+        self.secret = secret
+        self.bot = bot
+        self.update_queue = update_queue
+        metrics.gauge('webhook.queue_depth', update_queue.qsize)
+
+
+def make_server(updater: Updater) -> WebhookServer:
+    if not settings.BOT_WEBHOOK_SECRET:
+        raise ImproperlyConfigured('BOT_WEBHOOK_SECRET is required by the webhook')
+    address = (settings.BOT_WEBHOOK_LISTEN, settings.BOT_WEBHOOK_PORT)
+    path = urlparse(settings.BOT_WEBHOOK_URL).path or '/'
+    return WebhookServer(address, path, settings.BOT_WEBHOOK_SECRET, updater.bot, updater.dispatcher.update_queue)
+
+
+def run_webhook(updater: Updater):
+    """
+    Serve the webhook until SIGINT or SIGTERM, then stop the dispatcher.
+    """
+    server = make_server(updater)
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+    updater.job_queue.start()
+    # every replica sets the same webhook, Telegram keeps the last one
+    updater.bot.set_webhook(settings.BOT_WEBHOOK_URL, api_kwargs={'secret_token': settings.BOT_WEBHOOK_SECRET})
+
+    def stop(_signum, _frame):
+        # `shutdown` waits for `serve_forever`, which runs in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logger.info('Listening for updates on %s:%d%s', *server.server_address[:2], server.path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        updater.job_queue.stop()
+        updater.dispatcher.stop()
+        dispatcher_thread.join()
@@ -0,0 +1,71 @@
+"""
+Run the handlers on a pool of threads, the updates of a chat always on the same thread.
+
+The updates of a chat are handled in order, since GM mode and edits depend on it,
+while a slow call in one chat does not hold up the others.
+"""
+import functools
+import logging
+import threading
+import time
+from queue import Queue
+from typing import Callable, List
+
+from django.db import close_old_connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWorkers:
+    def __init__(self, size: int):
+        self.queues: List[Queue] = [Queue() for _ in range(size)]
+        self.threads: List[threading.Thread] = []
+
+    def start(self):
+        for index, queue in enumerate(self.queues):
+            metrics.gauge('workers.{}.queue_depth'.format(index), queue.qsize)
+            thread = threading.Thread(target=self.work, args=(index,), name='chat-worker-{}'.format(index))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, chat_id: int, func: Callable, *args):
+        self.queues[chat_id % len(self.queues)].put((func, args))
+
+    def work(self, index: int):
+        queue = self.queues[index]
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            func, args = job
+            close_old_connections()
+            started = time.perf_counter()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Error in %s', func.__name__)
+            elapsed = time.perf_counter() - started
+            metrics.incr('workers.{}.jobs'.format(index))
+            metrics.incr('workers.{}.time_ms'.format(index), int(elapsed * 1000))
+
+    def wrap(self, callback: Callable) -> Callable:
+        """
+        The callback of a handler, submitted to the worker of the chat instead of run in the dispatcher.
+        """
+        if not self.queues:
+            return callback
+
+        @functools.wraps(callback)
+        def submit(update, context):
+            chat = update.effective_chat
+            self.submit(chat.id if chat else 0, callback, update, context)
+        return submit
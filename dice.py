@@ -1,14 +1,19 @@
-import secrets
 import enum
+import heapq
 import typing
+from functools import lru_cache
 
 from pypeg2 import *
+
+import roller
 from entities import Entity, RollResult, Span
 
 
 class DiceErrorKind(enum.Enum):
     ZERO_DIVISION = 'ZERO_DIVISION'
     ROLL_SYNTAX_ERROR = 'ROLL_SYNTAX_ERROR'
+    PROBABILITY_TOO_COMPLEX = 'PROBABILITY_TOO_COMPLEX'
+    DICE_BUDGET_EXCEEDED = 'DICE_BUDGET_EXCEEDED'
 
 
 class RollError(RuntimeError):
@@ -20,45 +25,131 @@ class Env:
         self.face = face
 
 
+class Budget:
+    """
+    Limit of the evaluation cost, roughly the number of dice rolled, shared by the rolls of a message.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.spent = 0
+
+    def spend(self, cost: int):
+        if self.spent + cost > self.limit:
+            raise RollError(DiceErrorKind.DICE_BUDGET_EXCEEDED)
+        self.spent += cost
+
+
 class Number(Symbol):
     regex = re.compile(r'\d{1,4}')
 
     def eval(self, *_args):
         return int(self.name), self.name
 
+    def cost(self, _env):
+        return 1
+
+    def canonical(self, _env):
+        return str(int(self.name))
+
 
 class Operator(Symbol):
     display = ''
+    # written in the canonical form of expressions
+    symbol = ''
 
 
 class Add(Operator):
     regex = re.compile(r'\+')
     display = '+'
+    symbol = '+'
 
 
 class Sub(Operator):
     regex = re.compile(r'-')
     display = '-'
+    symbol = '-'
 
 
 class Mul(Operator):
     regex = re.compile(r'[*×]')
     display = '×'
+    symbol = '*'
 
 
 class Div(Operator):
     regex = re.compile(r'[/÷]')
     display = '÷'
+    symbol = '/'
 
 
 operator = [Add, Sub, Mul, Div]
 
 
+# more results than this are shown as `{...}`
+COLLAPSE_LIMIT = 16
+# rolls added by a single exploding die at most
+EXPLODE_DEPTH = 5
+
+DICE_REGEX = re.compile(r'(\d{0,4}[dD]\d{0,4})(!?)(?:([kKdD][hHlL])(\d{1,4}))?')
+
+
+@lru_cache(maxsize=1024)
+def dice_modifiers(name: str) -> typing.Tuple[str, bool, typing.Optional[str], int]:
+    """
+    `4d6!kh3` is split into `('4d6', True, 'kh', 3)`.
+    """
+    base, explode, keep, keep_counter = DICE_REGEX.fullmatch(name).groups()
+    if keep is None:
+        return base, bool(explode), None, 0
+    return base, bool(explode), keep.lower(), int(keep_counter)
+
+
+def explode_values(values: typing.List[int], face: int) -> typing.List[int]:
+    """
+    Roll one more die for every die showing the highest face, up to `EXPLODE_DEPTH` times.
+    """
+    result = list(values)
+    pending = values.count(face)
+    for _ in range(EXPLODE_DEPTH):
+        if pending == 0:
+            break
+        extra = roller.roll(face, pending)
+        result.extend(extra)
+        pending = extra.count(face)
+    return result
+
+
+def keep_values(values: typing.List[int], keep: str, counter: int) -> typing.List[int]:
+    """
+    Partial selection with a heap, the dropped dice are never sorted.
+    """
+    if keep[0] == 'd':
+        counter = max(len(values) - counter, 0)
+        keep = 'kl' if keep == 'dh' else 'kh'
+    if keep == 'kh':
+        return heapq.nlargest(counter, values)
+    return heapq.nsmallest(counter, values)
+
+
+def show_values(values: typing.List[int]) -> str:
+    if len(values) > COLLAPSE_LIMIT:
+        return '{...}'
+    return '{{{}}}'.format(', '.join(map(str, values)))
+
+
 class Dice(Symbol):
-    regex = re.compile(r'\d{0,4}[dD]\d{0,4}')
+    regex = DICE_REGEX
+
+    def modifiers(self) -> typing.Tuple[bool, typing.Optional[str], int]:
+        _, explode, keep, keep_counter = dice_modifiers(self.name)
+        return explode, keep, keep_counter
+
+    def suffix(self) -> str:
+        explode, keep, keep_counter = self.modifiers()
+        return ('!' if explode else '') + ('{}{}'.format(keep, keep_counter) if keep else '')
 
-    def eval(self, env: Env, result_sum=True):
-        match = self.name.split('d')
+    def counter_face(self, env: Env) -> typing.Tuple[int, int]:
+        match = dice_modifiers(self.name)[0].split('d')
         try:
             counter = int(match[0])
         except ValueError:
@@ -67,22 +158,53 @@ class Dice(Symbol):
             face = int(match[1])
         except:
             face = env.face
-
-        if face == 0 or counter == 0:
-            result = [0]
-        elif face == 1:
-            result = [1 for _ in range(counter)]
-        else:
-            result = [secrets.randbelow(face) + 1 for _ in range(counter)]
-        if len(result) > 16:
+        return counter, face
+
+    def cost(self, env: Env):
+        counter, _ = self.counter_face(env)
+        explode, _, _ = self.modifiers()
+        if explode:
+            return max(counter, 1) * (EXPLODE_DEPTH + 1)
+        return max(counter, 1)
+
+    def canonical(self, env: Env):
+        return '{}d{}{}'.format(*self.counter_face(env), self.suffix())
+
+    def eval(self, env: Env, reduce=sum):
+        """
+        `reduce` is one of `sum`, `max` and `min`, only the sum is appended to the text.
+        """
+        counter, face = self.counter_face(env)
+        explode, keep, keep_counter = self.modifiers()
+        if (explode or keep) and face > 0 and counter > 0:
+            values = roller.roll(face, counter)
+            if explode and face > 1:
+                values = explode_values(values, face)
+            result_text = '=' + show_values(values)
+            if keep:
+                values = keep_values(values, keep, keep_counter)
+                result_text += '→' + show_values(values)
+            result = reduce(values) if values else 0
+        elif counter > COLLAPSE_LIMIT and face > 1:
+            # the results are not shown, so they are never kept
+            result = roller.roll_reduce(face, counter, reduce)
             result_text = '={...}'
-        elif counter < 2:
-            result_text = ''
         else:
-            result_text = '={{{}}}'.format(', '.join(map(str, result)))
-        show = '{}d{}{}'.format(counter, face, result_text)
-        if result_sum:
-            result = sum(result)
+            if face == 0 or counter == 0:
+                values = [0]
+            elif face == 1:
+                values = [1 for _ in range(counter)]
+            else:
+                values = roller.roll(face, counter)
+            result = reduce(values)
+            if len(values) > COLLAPSE_LIMIT:
+                result_text = '={...}'
+            elif counter < 2:
+                result_text = ''
+            else:
+                result_text = '={{{}}}'.format(', '.join(map(str, values)))
+        show = '{}d{}{}{}'.format(counter, face, self.suffix(), result_text)
+        if reduce is sum:
             show += '={}'.format(result)
         return result, show
 
@@ -94,10 +216,15 @@ class Max:
         [('(', attr('dice', Dice), ')'), ('（', attr('dice', Dice), '）'), attr('dice', Dice)]
     )
 
+    def cost(self, env):
+        return self.dice.cost(env)
+
+    def canonical(self, env):
+        return 'max({})'.format(self.dice.canonical(env))
+
     def eval(self, env):
-        value, text = self.dice.eval(env, result_sum=False)
-        result = max(value)
-        return result, 'max {}'.format(text, result)
+        result, text = self.dice.eval(env, reduce=max)
+        return result, 'max {}'.format(text)
 
 
 class Min:
@@ -107,62 +234,125 @@ class Min:
         [('(', attr('dice', Dice), ')'), ('（', attr('dice', Dice), '）'), attr('dice', Dice)]
     )
 
+    def cost(self, env):
+        return self.dice.cost(env)
+
+    def canonical(self, env):
+        return 'min({})'.format(self.dice.canonical(env))
+
     def eval(self, env):
-        value, text = self.dice.eval(env, result_sum=False)
-        result = min(value)
-        return result, 'min {}'.format(text, min(value))
+        result, text = self.dice.eval(env, reduce=min)
+        return result, 'min {}'.format(text)
 
 
 # left recursion!
 # https://bitbucket.org/fdik/pypeg/issues/4/
 class Expr(List):
-    def eval(self, env):
-        value_list = []
-        show_list = []
+    def cost(self, env):
+        return sum(i.cost(env) for i in self if not isinstance(i, Operator))
 
+    def canonical(self, env):
+        parts = []
         for i in self:
-            if not isinstance(i, Operator):
-                v, show = i.eval(env)
-                value_list.append(v)
-                show_list.append(show)
+            if isinstance(i, Operator):
+                parts.append(i.symbol)
+            elif isinstance(i, Expr):
+                parts.append('({})'.format(i.canonical(env)))
             else:
-                show_list.append(i.display)
-                value_list.append(i)
-
-        for i, current in enumerate(value_list):
-            if isinstance(current, (Mul, Div)):
-                a = value_list[i - 1]
-                b = value_list[i + 1]
-                if isinstance(current, Mul):
-                    value_list[i + 1] = a * b
-                elif b == 0:
-                    raise RollError(DiceErrorKind.ZERO_DIVISION)
-                else:
-                    value_list[i + 1] = a // b
-                value_list[i] = None
-                value_list[i - 1] = None
-        value_list = list(filter(lambda x: x is not None, value_list))
-        result = value_list[0]
-        for i, current in enumerate(value_list):
-            if isinstance(current, Add):
-                result += value_list[i + 1]
-            elif isinstance(current, Sub):
-                result -= value_list[i + 1]
-        return result, '[{}]={}'.format(' '.join(show_list), result)
+                parts.append(i.canonical(env))
+        return ''.join(parts)
+
+    def eval(self, env):
+        return eval_items(self, env)
+
+
+def eval_items(items, env):
+    """
+    Operands and operators in turn, evaluated in one pass from left to right.
+    `term` is the product of `×` and `÷` not added to `result` yet.
+    """
+    show_list = []
+    result = 0
+    term = None
+    sign = 1
+    op = None
+    for i in items:
+        if isinstance(i, Operator):
+            op = i
+            show_list.append(i.display)
+            continue
+        v, show = i.eval(env)
+        show_list.append(show)
+        if op is None:
+            term = v
+        elif isinstance(op, Mul):
+            term *= v
+        elif isinstance(op, Div):
+            if v == 0:
+                raise RollError(DiceErrorKind.ZERO_DIVISION)
+            term //= v
+        else:
+            result += sign * term
+            sign = -1 if isinstance(op, Sub) else 1
+            term = v
+    result += sign * term
+    return result, '[{}]={}'.format(' '.join(show_list), result)
 
 
 item = [Dice, Number, Max, Min, ('(', Expr, ')')]
 Expr.grammar = (item, maybe_some(operator, item))
 
 
+class Times(Symbol):
+    regex = re.compile(r'\d{1,2}#')
+
+
+class Repeat:
+    """
+    `8#1d20+4`, the expression is parsed once and evaluated many times.
+    """
+    times = None
+    expr = None
+    grammar = attr('times', Times), attr('expr', Expr)
+
+    def counter(self) -> int:
+        return int(self.times.name[:-1])
+
+    def cost(self, env):
+        return self.counter() * self.expr.cost(env)
+
+    def canonical(self, env):
+        return self.expr.canonical(env)
+
+    def eval(self, env):
+        values = []
+        shows = []
+        for _ in range(self.counter()):
+            value, show = self.expr.eval(env)
+            values.append(value)
+            shows.append(show)
+        return values, '{} {}'.format(self.times.name, ', '.join(shows))
+
+
+PUNCTUATION = r'。.；，,、…！!？/ ⧸⁄—-【】“”"（）()：:\[\]{}<>《》〔〕『』‘’「」'
+WORD_REGEX = re.compile(r'[^' + PUNCTUATION + r'\s]+')
+PUNCTUATION_REGEX = re.compile(r'[' + PUNCTUATION + r']+')
+
+
 class Roll(List):
     grammar = maybe_some([
+        Repeat,
         Expr,
-        re.compile(r'[^。.；，,、…！!？/ ⧸⁄—-【】“”"（）()：:\[\]{}<>《》〔〕『』‘’「」\s]+'),
-        re.compile(r'[。.；，,、…！!？/ ⧸⁄—-【】“”"（）()：:\[\]{}<>《》〔〕『』‘’「」]+'),
+        WORD_REGEX,
+        PUNCTUATION_REGEX,
     ])
 
-    def eval_entities(self, env) -> typing.List[Entity]:
+    def cost(self, env):
+        return sum(e.cost(env) for e in self if not isinstance(e, str))
+
+    def eval_entities(self, env, budget: typing.Optional[Budget] = None) -> typing.List[Entity]:
+        if budget is not None:
+            budget.spend(self.cost(env))
         entities = []
         for e in self:
             if isinstance(e, str):
@@ -170,10 +360,12 @@ class Roll(List):
             else:
                 value, text = e.eval(env)
                 result_value = value
-                entities.append(RollResult(text, result_value))
+                entities.append(RollResult(text, result_value, e.canonical(env)))
         return entities
 
-    def eval(self, env):
+    def eval(self, env, budget: typing.Optional[Budget] = None):
+        if budget is not None:
+            budget.spend(self.cost(env))
         expr_count = 0
         result_value = 0
         result_text = []
@@ -191,19 +383,331 @@ class Roll(List):
         return result_value, ' '.join(result_text)
 
 
-def roll_entities(text, default_dice_face) -> typing.List[Entity]:
-    env = Env(face=default_dice_face)
+class BinaryOp:
+    def __init__(self, op: Operator, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+def flatten(node) -> list:
+    """
+    The operands and operators of a tree of `BinaryOp` in the order of the text, without recursion.
+    """
+    items = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, BinaryOp):
+            stack.append(node.right)
+            stack.append(node.op)
+            stack.append(node.left)
+        else:
+            items.append(node)
+    return items
+
+
+class Group:
+    """
+    An expression at the top level or in parentheses, same as `Expr` but holding a tree.
+
+    The tree has the same precedence as `Expr.eval`, so it is evaluated from the flat list of its operands and
+    operators, which is built once with the tree. Long expressions are left-deep trees, so nothing walks the tree
+    by recursion.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.items = flatten(root)
+
+    def cost(self, env):
+        return sum(i.cost(env) for i in self.items if not isinstance(i, Operator))
+
+    def canonical(self, env):
+        parts = []
+        for i in self.items:
+            if isinstance(i, Operator):
+                parts.append(i.symbol)
+            elif isinstance(i, Group):
+                parts.append('({})'.format(i.canonical(env)))
+            else:
+                parts.append(i.canonical(env))
+        return ''.join(parts)
+
+    def eval(self, env):
+        return eval_items(self.items, env)
+
+
+# Every token stays inside one run of word, punctuation or blank characters,
+# so the text fallback of `Roll` always ends on a token boundary.
+TOKEN_REGEX = re.compile(
+    r'(?P<dice>\d{0,4}[dD]\d{0,4})(?P<explode>!)?(?P<keep>[kKdD][hHlL]\d{1,4})?'
+    r'|(?P<number>\d{1,4})'
+    r'|(?P<max>最大|max|MAX|Max)'
+    r'|(?P<min>最小|min|Min|MIN)'
+    r'|(?P<operator>[-+*×/÷])'
+    r'|(?P<open>\()'
+    r'|(?P<close>\))'
+    r'|(?P<wide_open>（)'
+    r'|(?P<wide_close>）)'
+    r'|(?P<hash>#)'
+    r'|(?P<space>\s+)'
+    r'|(?P<text>[^' + PUNCTUATION + r'\s\ddDmM最\-+*×÷#]+|(?:(?![()（）/\s])[' + PUNCTUATION + r'])+)'
+    r'|(?P<char>.)',
+    re.DOTALL,
+)
+PUNCTUATION_CHAR = re.compile(r'[' + PUNCTUATION + r']')
+SPACE_CHAR = re.compile(r'\s')
+
+OPERATOR_TOKEN = {
+    '+': Add, '-': Sub,
+    '*': Mul, '×': Mul,
+    '/': Div, '÷': Div,
+}
+BINDING_POWER = {Add: 10, Sub: 10, Mul: 20, Div: 20}
+
+
+class Token:
+    def __init__(self, kind: str, text: str, start: int, end: int):
+        self.kind = kind
+        self.text = text
+        self.start = start
+        self.end = end
+        # end of the run of characters of the same class
+        self.run_end = end
+
+
+def char_class(text: str, index: int) -> int:
+    if PUNCTUATION_CHAR.match(text, index):
+        return 1
+    elif SPACE_CHAR.match(text, index):
+        return 2
+    return 0
+
+
+def token_spans(text: str) -> typing.Iterator[typing.Tuple[str, int, int]]:
+    for match in TOKEN_REGEX.finditer(text):
+        if match.group('dice') is None:
+            yield match.lastgroup, match.start(), match.end()
+            continue
+        # the `!` of `1d6!` is a punctuation, split it off to keep every token inside one run
+        for kind in ('dice', 'explode', 'keep'):
+            if match.group(kind) is not None:
+                yield kind, match.start(kind), match.end(kind)
+
+
+def tokenize(text: str) -> typing.List[Token]:
+    """
+    Split the text in a single pass, blanks are dropped.
+    """
+    tokens = []
+    run = []
+    run_class = None
+    for kind, start, end in token_spans(text):
+        current_class = char_class(text, start)
+        if current_class != run_class:
+            for token in run:
+                token.run_end = start
+            run = []
+            run_class = current_class
+        if kind == 'space':
+            # blanks in the punctuation class may split into both classes
+            for i in range(start + 1, end):
+                if char_class(text, i) != run_class:
+                    for token in run:
+                        token.run_end = i
+                    run = []
+                    run_class = char_class(text, i)
+            continue
+        token = Token(kind, text[start:end], start, end)
+        tokens.append(token)
+        run.append(token)
+    for token in run:
+        token.run_end = len(text)
+    return tokens
+
+
+# deeper parentheses are text, the parser and the evaluation recurse into each of them
+MAX_NESTING = 32
+
+
+class Parser:
+    """
+    Operator precedence (Pratt) parser produces the same result as the pypeg2 grammar.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.index = 0
+        # parentheses around the current token
+        self.depth = 0
+
+    def peek(self) -> typing.Optional[Token]:
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None
+
+    def accept(self, kind: str) -> typing.Optional[Token]:
+        token = self.peek()
+        if token is not None and token.kind == kind:
+            self.index += 1
+            return token
+        return None
+
+    def parse(self) -> Roll:
+        result = []
+        while self.index < len(self.tokens):
+            repeat = self.repeat()
+            if repeat is not None:
+                result.append(repeat)
+                continue
+            expr = self.expression()
+            if expr is not None:
+                result.append(Group(expr))
+                continue
+            # fallback to the plain text till the end of the run
+            token = self.tokens[self.index]
+            result.append(self.text[token.start:token.run_end])
+            while self.index < len(self.tokens) and self.tokens[self.index].start < token.run_end:
+                self.index += 1
+        return Roll(result)
+
+    def repeat(self) -> typing.Optional[Repeat]:
+        start = self.index
+        times = self.accept('number')
+        mark = self.accept('hash')
+        if times and mark and len(times.text) <= 2 and times.end == mark.start:
+            expr = self.expression()
+            if expr is not None:
+                repeat = Repeat()
+                repeat.times = Times(times.text + mark.text)
+                repeat.expr = Group(expr)
+                return repeat
+        self.index = start
+        return None
+
+    def expression(self, min_power=0):
+        left = self.item()
+        if left is None:
+            return None
+        while True:
+            token = self.peek()
+            if token is None or token.kind != 'operator':
+                return left
+            op = OPERATOR_TOKEN[token.text]
+            power = BINDING_POWER[op]
+            if power <= min_power:
+                return left
+            self.index += 1
+            right = self.expression(power)
+            if right is None:
+                # operator without operand does not belong to the expression
+                self.index -= 1
+                return left
+            left = BinaryOp(op(token.text), left, right)
+
+    def item(self):
+        start = self.index
+        token = self.peek()
+        if token is None:
+            return None
+        self.index += 1
+        kind = token.kind
+        if kind == 'dice':
+            return self.dice_modifiers(token)
+        elif kind == 'number':
+            return Number(token.text)
+        elif kind == 'max' or kind == 'min':
+            dice = self.dice_argument()
+            if dice is not None:
+                node = Max() if kind == 'max' else Min()
+                node.dice = dice
+                return node
+        elif kind == 'open' and self.depth < MAX_NESTING:
+            self.depth += 1
+            expr = self.expression()
+            self.depth -= 1
+            if expr is not None and self.accept('close'):
+                return Group(expr)
+        elif kind == 'keep' and token.text[0] in 'dD':
+            # left behind by a dice in the text, `dh3` is the dice `d` followed by `h3`
+            dice_token = Token('dice', token.text[0], token.start, token.start + 1)
+            rest = Token('text', token.text[1:], token.start + 1, token.end)
+            dice_token.run_end = rest.run_end = token.run_end
+            self.tokens[start:start + 1] = [dice_token, rest]
+            return Dice(dice_token.text)
+        self.index = start
+        return None
+
+    def dice_modifiers(self, token: Token) -> Dice:
+        """
+        Join the `!` and `kh3` tokens split from the dice token.
+        """
+        text = token.text
+        for kind in ('explode', 'keep'):
+            modifier = self.accept(kind)
+            if modifier is not None:
+                text += modifier.text
+        return Dice(text)
+
+    def dice_argument(self) -> typing.Optional[Dice]:
+        start = self.index
+        for open_kind, close_kind in (('open', 'close'), ('wide_open', 'wide_close'), (None, None)):
+            self.index = start
+            if open_kind and not self.accept(open_kind):
+                continue
+            token = self.accept('dice')
+            if token is None:
+                continue
+            dice = self.dice_modifiers(token)
+            if close_kind and not self.accept(close_kind):
+                continue
+            return dice
+        self.index = start
+        return None
+
+
+# The parsed tree is never mutated by `eval`, so it can be shared between calls.
+# Only short texts are cached to keep the memory usage bounded.
+PARSE_CACHE_SIZE = 1024
+PARSE_CACHE_MAX_LENGTH = 256
+
+
+# `pypeg2` is the original grammar, kept as the reference implementation.
+PARSERS = {
+    'pratt': lambda text: Parser(text).parse(),
+    'pypeg2': lambda text: parse(text, Roll),
+}
+DEFAULT_PARSER = 'pratt'
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_cached(text: str, parser: str) -> Roll:
+    return PARSERS[parser](text)
+
+
+def parse_roll(text: str, parser=None) -> Roll:
+    # keyed by the exact text, the spaces around an expression are kept in its text spans
+    parser = parser or DEFAULT_PARSER
     try:
-        roll_ast = parse(text, Roll)
+        if len(text) > PARSE_CACHE_MAX_LENGTH:
+            return PARSERS[parser](text)
+        return _parse_cached(text, parser)
     except SyntaxError:
         raise RollError(DiceErrorKind.ROLL_SYNTAX_ERROR)
-    return roll_ast.eval_entities(env)
 
 
-def roll(text, default_dice_face):
+def parse_cache_info():
+    """
+    Hits, misses and size of the parse cache.
+    """
+    return _parse_cached.cache_info()
+
+
+def roll_entities(text, default_dice_face, parser=None, budget=None) -> typing.List[Entity]:
     env = Env(face=default_dice_face)
-    try:
-        roll_ast = parse(text, Roll)
-    except SyntaxError:
-        raise RollError(DiceErrorKind.ROLL_SYNTAX_ERROR)
-    return roll_ast.eval(env)
+    return parse_roll(text, parser).eval_entities(env, budget)
+
+
+def roll(text, default_dice_face, parser=None, budget=None):
+    env = Env(face=default_dice_face)
+    return parse_roll(text, parser).eval(env, budget)
@@ -1,25 +1,59 @@
+import html
 import re
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 
 def escape(text: str) -> str:
-    text = text.replace('&', '&amp;')
-    text = text.replace('<', '&lt;')
-    text = text.replace('>', '&gt;')
-    return text
+    # most texts have nothing to escape and are returned as they are
+    if '&' not in text and '<' not in text and '>' not in text:
+        return text
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def escape_archive(value) -> str:
+    """
+    The same as the autoescape of Django templates.
+    """
+    text = str(value)
+    if '&' not in text and '<' not in text and '>' not in text and '"' not in text and "'" not in text:
+        return text
+    return html.escape(text)
 
 
 class Entity:
+    __slots__ = ()
     kind = 'none'
     value = None
+    # attributes stored in the object, in the order of the arguments of `__init__`
+    fields: Tuple[str, ...] = ()
 
     def object(self) -> dict:
-        obj = self.__dict__
+        obj = {}
+        for name in self.fields:
+            obj[name] = getattr(self, name)
         obj['kind'] = self.kind
         return obj
 
+    def compact(self) -> list:
+        """
+        `[code, *fields]`, without the keys of the object.
+        """
+        result = [ENTITY_CODE[self.kind]]
+        for name in self.fields:
+            result.append(getattr(self, name))
+        return result
+
+    def write_telegram_html(self, out: List[str]):
+        pass
+
+    def write_archive_html(self, out: List[str]):
+        out.append('<span class="entity-unknown">Unknown</span>')
+
     def telegram_html(self):
-        return ''
+        return render_html((self,))
+
+    def archive_html(self):
+        return render_html((self,), archive=True)
 
     @staticmethod
     def from_object(obj: dict) -> 'Entity':
@@ -30,6 +64,7 @@ class Entity:
 
 
 class Entities:
+    __slots__ = ('list',)
     list: List[Entity]
 
     def __init__(self, li=None):
@@ -38,6 +73,9 @@ class Entities:
     def to_object(self) -> List[dict]:
         return make_entities_object(self.list)
 
+    def to_compact(self) -> List[list]:
+        return [entity.compact() for entity in self.list]
+
     @staticmethod
     def from_html(html: str) -> 'Entities':
         new = Entities()
@@ -45,21 +83,43 @@ class Entities:
         return new
 
     @staticmethod
-    def from_object(xs: List[dict]) -> 'Entities':
+    def from_object(xs: List[Union[dict, list]]) -> 'Entities':
+        """
+        Read the stored entities, either objects or the compact form.
+        """
         return Entities(list(map(object_to_entity, xs)))
 
+    @staticmethod
+    def from_objects(pages: Iterable[Optional[List[Union[dict, list]]]]) -> List['Entities']:
+        """
+        Decode the entities of many logs, e.g. a chunk rendered again by `render_logs`.
+        """
+        decode = object_to_entity
+        return [Entities([decode(obj) for obj in xs or ()]) for xs in pages]
+
     def telegram_html(self) -> str:
         return entities_to_telegram_html(self.list)
 
+    def archive_html(self) -> str:
+        """
+        Rendered once when the log is written, and shown as it is in the archive.
+        """
+        return render_html(self.list, archive=True)
+
 
 class Span(Entity):
     kind = 'span'
+    fields = ('value',)
+    __slots__ = fields
 
     def __init__(self, text):
         self.value = text
 
-    def telegram_html(self):
-        return escape(self.value)
+    def write_telegram_html(self, out: List[str]):
+        out.append(escape(self.value))
+
+    def write_archive_html(self, out: List[str]):
+        out += ('<span class="entity-span">', escape_archive(self.value), '</span>')
 
     @staticmethod
     def from_object(obj: dict) -> 'Span':
@@ -68,14 +128,22 @@ class Span(Entity):
 
 class Character(Entity):
     kind = 'character'
+    fields = ('value', 'player_id', 'full_name')
+    __slots__ = fields
 
     def __init__(self, character: str, player_id: int, full_name: str):
         self.value = character
         self.player_id = player_id
         self.full_name = full_name
 
-    def telegram_html(self):
-        return '<b>{}</b>'.format(escape(self.value))
+    def write_telegram_html(self, out: List[str]):
+        out += ('<b>', escape(self.value), '</b>')
+
+    def write_archive_html(self, out: List[str]):
+        out += (
+            '<strong class="entity-character" title="', escape_archive(self.full_name), '">',
+            escape_archive(self.value), '</strong>',
+        )
 
     @staticmethod
     def from_object(obj: dict) -> 'Character':
@@ -83,6 +151,7 @@ class Character(Entity):
 
 
 class Me(Character):
+    __slots__ = ()
     kind = 'me'
 
     @staticmethod
@@ -92,12 +161,17 @@ class Me(Character):
 
 class Bold(Entity):
     kind = 'bold'
+    fields = ('value',)
+    __slots__ = fields
 
     def __init__(self, text):
         self.value = text
 
-    def telegram_html(self):
-        return '<b>{}</b>'.format(escape(self.value))
+    def write_telegram_html(self, out: List[str]):
+        out += ('<b>', escape(self.value), '</b>')
+
+    def write_archive_html(self, out: List[str]):
+        out += ('<strong class="entity-bold">', escape_archive(self.value), '</strong>')
 
     @staticmethod
     def from_object(obj: dict) -> 'Bold':
@@ -106,12 +180,17 @@ class Bold(Entity):
 
 class Code(Entity):
     kind = 'code'
+    fields = ('value',)
+    __slots__ = fields
 
     def __init__(self, text):
         self.value = text
 
-    def telegram_html(self):
-        return '<code>{}</code>'.format(escape(self.value))
+    def write_telegram_html(self, out: List[str]):
+        out += ('<code>', escape(self.value), '</code>')
+
+    def write_archive_html(self, out: List[str]):
+        out += ('<code class="entity-code">', escape_archive(self.value), '</code>')
 
     @staticmethod
     def from_object(obj: dict) -> 'Code':
@@ -120,30 +199,45 @@ class Code(Entity):
 
 class RollResult(Entity):
     kind = 'roll'
+    fields = ('value', 'result', 'expression')
+    __slots__ = fields
 
-    def __init__(self, text, result=None):
+    def __init__(self, text, result=None, expression=None):
         self.value = text
         self.result = result
+        # canonical form of the rolled expression, e.g. `1d20+5`
+        self.expression = expression
 
-    def telegram_html(self):
-        return ' <code>{}</code> '.format(escape(self.value))
+    def write_telegram_html(self, out: List[str]):
+        out += (' <code>', escape(self.value), '</code> ')
+
+    def write_archive_html(self, out: List[str]):
+        out += ('<span class="entity-roll">', escape_archive(self.value), '</span>')
 
     @staticmethod
     def from_object(obj: dict) -> 'RollResult':
-        return RollResult(obj['value'], obj['result'])
+        return RollResult(obj['value'], obj['result'], obj.get('expression'))
 
 
 class LoopResult(Entity):
     kind = 'loop-roll'
+    fields = ('rolled',)
+    __slots__ = fields
 
     def __init__(self, rolled: List[int]):
         self.rolled = rolled
 
-    def telegram_html(self):
+    def write_telegram_html(self, out: List[str]):
         counter_6 = self.rolled.count(6)
         counter_all = len(self.rolled)
         rolled_text = ', '.join(map(str, self.rolled))
-        return ' <code>({}/{}) [{}]</code> '.format(counter_6, counter_all, rolled_text)
+        out.append(' <code>({}/{}) [{}]</code> '.format(counter_6, counter_all, rolled_text))
+
+    def write_archive_html(self, out: List[str]):
+        out.append((
+            '<span class="entity-loop-roll"><span class="counter">{}/{}</span>'
+            '<span class="rolled">{}</span></span>'
+        ).format(self.rolled.count(6), len(self.rolled), escape_archive(self.rolled)))
 
     @staticmethod
     def from_object(obj: dict) -> 'LoopResult':
@@ -152,6 +246,8 @@ class LoopResult(Entity):
 
 class CocResult(Entity):
     kind = 'coc-roll'
+    fields = ('rolled', 'level', 'modifier_name', 'rolled_list')
+    __slots__ = fields + ('value',)
 
     def __init__(self, rolled: int, level: str,
                  modifier_name: Optional[str], rolled_list: List[int]):
@@ -162,64 +258,135 @@ class CocResult(Entity):
 
         self.value = level
 
-    def telegram_html(self):
-        result = '<code>{rolled}</code> {level}'.format(
+    def write_telegram_html(self, out: List[str]):
+        out.append('<code>{rolled}</code> {level}'.format(
             rolled=self.rolled, level=self.level,
-        )
+        ))
         if self.modifier_name:
-            result += '\n\n{modifier_name}: <code>{rolled_list}</code>'.format(
+            out.append('\n\n{modifier_name}: <code>{rolled_list}</code>'.format(
                 modifier_name=self.modifier_name,
                 rolled_list=', '.join(map(str, self.rolled_list)),
+            ))
+
+    def write_archive_html(self, out: List[str]):
+        out += (
+            '<span class="entity-coc-roll"><span class="rolled">', escape_archive(self.rolled),
+            '</span><span class="level">', escape_archive(self.level), '</span>',
+        )
+        if self.modifier_name:
+            out += (
+                '<span class="modifier-name">', escape_archive(self.modifier_name),
+                '</span><span class="modifier-list">', escape_archive(self.rolled_list), '</span>',
             )
-        return result
+        out.append('</span>')
+
+    def object(self) -> dict:
+        obj = super().object()
+        # the same as `level`, kept in the stored object
+        obj['value'] = self.value
+        return obj
 
     @staticmethod
     def from_object(obj: dict) -> 'CocResult':
         return CocResult(obj['rolled'], obj['level'], obj['modifier_name'], obj['rolled_list'])
 
 
-CODE_REGEX = re.compile(r'<(code)>(.+?)</code>')
-BOLD_REGEX = re.compile(r'<(b)>(.+?)</b>')
+# `<code>` and `<b>` in one pattern, the leftmost tag wins
+TAG_REGEX = re.compile(r'<(?:code>(?P<code>.+?)</code>|b>(?P<b>.+?)</b>)')
 
 
-def convert_to_entities(content: str) -> List[Entity]:
-    matches = list(CODE_REGEX.finditer(content))
-    matches.extend(BOLD_REGEX.finditer(content))
-    matches.sort(key=lambda m: m.start())
-    entities = []
+def iter_entities(content: str) -> Iterator[Entity]:
+    """
+    Scan the content once, the text between the tags is yielded as `Span`.
+    """
     last_index = 0
-    for match in matches:
-        tag = match.group(1)
-        text = match.group(2)
+    for match in TAG_REGEX.finditer(content):
         start = match.start()
-        if start < last_index:
-            continue
-        segment = content[last_index:start]
-        if segment:
-            entities.append(Span(segment))
+        if start > last_index:
+            yield Span(content[last_index:start])
         last_index = match.end()
-        if tag == 'code':
-            entities.append(Code(text))
-        elif tag == 'b':
-            entities.append(Bold(text))
-    if last_index < len(content) - 1:
-        entities.append(Span(content[last_index:]))
-    return entities
+        if match.lastgroup == 'code':
+            yield Code(match.group('code'))
+        else:
+            yield Bold(match.group('b'))
+    if last_index < len(content):
+        yield Span(content[last_index:])
+
+
+def convert_to_entities(content: str) -> List[Entity]:
+    return list(iter_entities(content))
+
+
+UNKNOWN = Entity()
+
+
+def render_html(entities: Iterable[Optional[Entity]], archive=False) -> str:
+    """
+    Every entity writes its pieces into one list, which is joined once.
+    The archive puts a line break between the entities, as the template of the archive did.
+    """
+    out = []
+    for entity in entities:
+        if entity is None:
+            entity = UNKNOWN
+        if archive:
+            if out:
+                out.append('\n')
+            entity.write_archive_html(out)
+        else:
+            entity.write_telegram_html(out)
+    return ''.join(out)
 
 
 def entities_to_telegram_html(entities: List[Entity]) -> str:
-    html = ''.join(map(lambda e: e.telegram_html(), entities))
-    return html.strip()
+    return render_html(entities).strip()
 
 
 def make_entities_object(entities: List[Entity]):
     return list([entity.object() for entity in entities])
 
 
-def object_to_entity(obj: dict) -> Optional[Entity]:
-    kind = obj.get('kind', '')
-    for E in (Span, Character, Me, Bold, Code, RollResult, LoopResult, CocResult):
-        if E.kind == kind:
-            return E.from_object(obj)
-    return None
+# the index is the code stored in the compact form, only append to it
+ENTITY_CODES = (Span, Character, Me, Bold, Code, RollResult, LoopResult, CocResult)
+ENTITY_CLASSES = {E.kind: E for E in ENTITY_CODES}
+ENTITY_CODE = {E.kind: code for code, E in enumerate(ENTITY_CODES)}
+
+
+def object_to_entity(obj: Union[dict, list]) -> Optional[Entity]:
+    if isinstance(obj, list):
+        code = obj[0]
+        if not 0 <= code < len(ENTITY_CODES):
+            return None
+        return ENTITY_CODES[code](*obj[1:])
+    E = ENTITY_CLASSES.get(obj.get('kind', ''))
+    if E is None:
+        return None
+    return E.from_object(obj)
+
+
+def stored_objects(xs: List[Union[dict, list]]) -> List[dict]:
+    """
+    The stored entities as objects, for the templates and exports.
+    """
+    result = []
+    for obj in xs:
+        if isinstance(obj, list):
+            entity = object_to_entity(obj)
+            obj = entity.object() if entity is not None else {'kind': 'none'}
+        result.append(obj)
+    return result
+
+
+def compact_objects(xs: List[Union[dict, list]]) -> List[Union[dict, list]]:
+    """
+    The stored entities in the compact form, objects of unknown kinds are kept as they are.
+    """
+    result = []
+    for obj in xs:
+        if isinstance(obj, dict):
+            entity = object_to_entity(obj)
+            if entity is not None:
+                obj = entity.compact()
+        result.append(obj)
+    return result
 
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the dice engine'
+
+    def add_arguments(self, parser):
+        parser.add_argument('groups', nargs='*', choices=list(benchmark.GROUPS))
+        parser.add_argument('--seed', help='roll from a deterministic generator')
+
+    def handle(self, *args, **options):
+        benchmark.main(options['groups'], options['seed'])
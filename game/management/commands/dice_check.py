@@ -0,0 +1,79 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+import dice
+import roller
+
+SAMPLES = [
+    '1d20+5',
+    '4d6',
+    '1d100',
+    '2d6*3 伤害',
+    '(1-6)/4',
+    '2*3+4*5-6/2*3',
+    'max(2d20) 最小（2d20） min 3d6',
+    '他拔出长剑，1d20+5 攻击。然后 2d6*3 伤害！',
+    'abc1d20 1d20abc 12345d6 3D6 1d20+abc',
+    '((1d20+2)*3)/2d4',
+    'd 1d20d maxd',
+    '8#1d20+4 先攻',
+    '1+2#1d6 123#1d6 12345#d6 3# 2d6 #1d6 4#x',
+    '4d6kh3 2d20kl1 d6! 4d6dl1 3d6!kh2 max(4d6!) abc1d6!kh2x 1d6!! 4d6Kh 4d6dh1!',
+    'x1d6!dh2 nD!Dh3+1 4d6!kl1/2',
+]
+ALPHABET = list('0123456789dDmaxinMAX最大小+-*×/÷()（） ,.。，\n\t　abc—…!#') + ['max', 'min', '1d20', '最大', '2d6', '8#', 'kh', 'kl1', 'dh', '!', '4d6k', 'h3']
+
+
+def shape(node):
+    if isinstance(node, dice.Repeat):
+        return 'repeat', str(node.times), shape(node.expr)
+    elif isinstance(node, dice.Group):
+        return 'expr', tuple(shape(x) for x in node.items)
+    elif isinstance(node, dice.Expr):
+        return 'expr', tuple(shape(x) for x in node)
+    elif isinstance(node, (dice.Max, dice.Min)):
+        return type(node).__name__, str(node.dice)
+    elif isinstance(node, dice.Operator):
+        return 'operator', node.display
+    elif isinstance(node, (dice.Dice, dice.Number)):
+        return type(node).__name__, str(node)
+    return 'text', node
+
+
+def evaluate(text, parser, seed):
+    roller.use_seed(seed)
+    try:
+        entities = dice.roll_entities(text, 20, parser)
+        return repr(entities) + repr([getattr(x, 'expression', None) for x in entities])
+    except dice.RollError as e:
+        return repr(e)
+    finally:
+        roller.use_seed(None)
+
+
+class Command(BaseCommand):
+    help = 'Check that the dice parsers produce the same results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--random', type=int, default=10000, help='number of random inputs')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        texts = list(SAMPLES)
+        for _ in range(options['random']):
+            texts.append(''.join(rand.choice(ALPHABET) for _ in range(rand.randint(0, 32))))
+        failed = 0
+        for i, text in enumerate(texts):
+            expected = [shape(x) for x in dice.PARSERS['pypeg2'](text)]
+            actual = [shape(x) for x in dice.PARSERS['pratt'](text)]
+            if expected == actual:
+                expected = evaluate(text, 'pypeg2', i)
+                actual = evaluate(text, 'pratt', i)
+            if expected != actual:
+                failed += 1
+                self.stdout.write('{!r}\n  pypeg2: {}\n  pratt:  {}'.format(text, expected, actual))
+        self.stdout.write('{} checked, {} failed'.format(len(texts), failed))
+        if failed:
+            raise SystemExit(1)
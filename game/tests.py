@@ -1 +1,89 @@
-# Create your tests here.
+import random
+import time
+
+from django.test import SimpleTestCase
+
+import dice
+import entities
+import probability
+from game.management.commands.dice_check import SAMPLES, ALPHABET, shape, evaluate
+
+
+class ParserTest(SimpleTestCase):
+    """
+    The Pratt parser against the pypeg2 grammar, the same check as `manage.py dice_check`.
+    """
+
+    def assert_same(self, text: str, seed: int):
+        expected = [shape(x) for x in dice.PARSERS['pypeg2'](text)]
+        actual = [shape(x) for x in dice.PARSERS['pratt'](text)]
+        self.assertEqual(expected, actual, text)
+        self.assertEqual(evaluate(text, 'pypeg2', seed), evaluate(text, 'pratt', seed), text)
+
+    def test_samples(self):
+        for i, text in enumerate(SAMPLES):
+            with self.subTest(text=text):
+                self.assert_same(text, i)
+
+    def test_cached_text(self):
+        for text in ('1d20， ', ' 1d20', '1d20 ', '1d20'):
+            with self.subTest(text=text):
+                expected = [shape(x) for x in dice.PARSERS['pypeg2'](text)]
+                self.assertEqual(expected, [shape(x) for x in dice.parse_roll(text)])
+                self.assertEqual(expected, [shape(x) for x in dice.parse_roll(text)])
+
+    def test_random(self):
+        rand = random.Random(0)
+        for i in range(2000):
+            text = ''.join(rand.choice(ALPHABET) for _ in range(rand.randint(0, 32)))
+            with self.subTest(text=text):
+                self.assert_same(text, i)
+
+
+class LongExpressionTest(SimpleTestCase):
+    """
+    Long expressions are never walked by recursion.
+    """
+    TEXTS = ('+'.join(['1'] * 2000), '1d6+' * 1000 + '1', '*'.join(['1'] * 2000), '(' * 600 + '1d6' + ')' * 600)
+
+    def test_roll(self):
+        for text in self.TEXTS:
+            with self.subTest(text=text[:16]):
+                result = dice.roll_entities(text, 20, budget=dice.Budget(10000))
+                self.assertTrue(any(isinstance(x, entities.RollResult) for x in result))
+
+    def test_cost_and_canonical(self):
+        env = dice.Env(face=20)
+        item = dice.parse_roll('+'.join(['1d6'] * 2000))[0]
+        self.assertEqual(item.cost(env), 2000)
+        self.assertEqual(item.canonical(env), '+'.join(['1d6'] * 2000))
+
+    def test_probability(self):
+        self.assertEqual(probability.expression_distribution('+'.join(['1'] * 2000), 20).minimum, 2000)
+        with self.assertRaises(dice.RollError):
+            probability.expression_distribution('1d6+' * 1000 + '1', 20)
+
+
+class ProbabilityLimitTest(SimpleTestCase):
+    """
+    Large expressions are refused before their distributions are computed.
+    """
+
+    def setUp(self):
+        probability.cache.clear()
+
+    def test_refused(self):
+        for text in (
+            'max(9999d9999)', 'min(9999d9999)', 'max(9999d9999)*max(9999d9999)', '9999d9999kh1', '300d9999kh1',
+            '9999d1000!', '140d100', '1000d6', '50d6!kh20', '+'.join(['1d20'] * 600),
+        ):
+            with self.subTest(text=text):
+                start = time.thread_time()
+                with self.assertRaises(dice.RollError):
+                    probability.expression_distribution(text, 20)
+                self.assertLess(time.thread_time() - start, 0.5)
+
+    def test_accepted(self):
+        for text, size in (('4d6kh3', 16), ('max(2d20)', 20), ('1d100*1d100', 10000), ('8d6!', 281), ('50d100', 4951)):
+            with self.subTest(text=text):
+                self.assertEqual(len(probability.expression_distribution(text, 20).counts), size)
@@ -52,6 +52,19 @@ if DEBUG:
     INSTALLED_APPS.append('corsheaders')
 
 BOT_TOKEN = os.environ['BOT_TOKEN']
+# another Bot API server, e.g. a local one in tests, in the form of `http://localhost:8081/bot`
+BOT_API_URL = os.getenv('BOT_API_URL')
+# receive updates on this url instead of long polling, e.g. `https://bot.example.com/telegram`
+BOT_WEBHOOK_URL = os.getenv('BOT_WEBHOOK_URL')
+BOT_WEBHOOK_LISTEN = os.getenv('BOT_WEBHOOK_LISTEN', '0.0.0.0')
+BOT_WEBHOOK_PORT = int(os.getenv('BOT_WEBHOOK_PORT', 8443))
+# sent back by Telegram with every update, others are refused
+BOT_WEBHOOK_SECRET = os.getenv('BOT_WEBHOOK_SECRET', '')
+# serve the counters of the bot as JSON on this port, 0 does not serve them
+BOT_METRICS_LISTEN = os.getenv('BOT_METRICS_LISTEN', '127.0.0.1')
+BOT_METRICS_PORT = int(os.getenv('BOT_METRICS_PORT', 0))
+# threads running the handlers, the updates of a chat always go to the same one, 0 runs them in the dispatcher
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 4))
 
 LOGOUT_URL = '/logout'
 
@@ -62,7 +75,7 @@ REDIS_URL = 'redis://{host}:{port}/{db}'.format(host=REDIS_HOST, port=REDIS_PORT
 
 CELERY_BROKER_URL = REDIS_URL
 CELERY_BACKEND_URL = REDIS_URL
-CELERY_IMPORTS = ['bot']
+CELERY_IMPORTS = ['bot', 'archive.distributions']
 CELERY_IGNORE_RESULT = True
 
 CACHES = {
@@ -263,3 +276,20 @@ for path in [STATIC_ROOT, MEDIA_ROOT, LOG_ROOT]:
 
 
 ARCHIVE_URL = os.getenv('ARCHIVE_URL', 'http://log.mythal.net')
+
+# Dice evaluation cost, about the number of dice rolled
+DICE_MESSAGE_BUDGET = int(os.getenv('DICE_MESSAGE_BUDGET', 50000))
+# shared by all messages of a chat in a window of seconds
+DICE_CHAT_BUDGET = int(os.getenv('DICE_CHAT_BUDGET', 200000))
+DICE_CHAT_BUDGET_WINDOW = int(os.getenv('DICE_CHAT_BUDGET_WINDOW', 60))
+# CPU seconds of .sim simulations, per message and per chat in a window of seconds
+SIMULATION_MESSAGE_CPU_TIME = float(os.getenv('SIMULATION_MESSAGE_CPU_TIME', 0.5))
+SIMULATION_CHAT_CPU_TIME = float(os.getenv('SIMULATION_CHAT_CPU_TIME', 2))
+SIMULATION_CHAT_CPU_WINDOW = int(os.getenv('SIMULATION_CHAT_CPU_WINDOW', 60))
+
+# roll from a deterministic generator seeded with this value, for replays and load tests only, the handlers
+# then run in the dispatcher whatever BOT_WORKERS is
+DICE_SEED = os.getenv('DICE_SEED')
+
+# store `Log.entities` as `[code, *fields]` lists instead of objects
+COMPACT_LOG_ENTITIES = bool(os.getenv('COMPACT_LOG_ENTITIES', False))
@@ -0,0 +1,536 @@
+"""
+Exact outcome distributions of dice expressions.
+
+Outcomes are counted with integers, so every probability is exact until it is shown.
+"""
+import threading
+import typing
+from collections import OrderedDict
+from functools import wraps
+from math import comb
+
+import dice
+from dice import Env, RollError, DiceErrorKind, Add, Sub, Mul, Div
+
+# outcomes of one distribution
+MAX_RANGE = 100000
+# size of the integers used in polynomial multiplication
+MAX_BITS = 1 << 21
+# pairs of outcomes enumerated in a multiplication or division
+MAX_PAIRS = 250000
+# states visited while choosing the kept dice
+MAX_STATES = 100000
+# estimated size of the cached distributions, shared by every cached function
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class Distribution:
+    def __init__(self, offset: int, counts: typing.List[int], total: int):
+        # counts[i] is the number of ways to get `offset + i`
+        self.offset = offset
+        self.counts = counts
+        self.total = total
+
+    @property
+    def minimum(self) -> int:
+        return self.offset
+
+    @property
+    def maximum(self) -> int:
+        return self.offset + len(self.counts) - 1
+
+    def items(self) -> typing.Iterator[typing.Tuple[int, int]]:
+        for i, count in enumerate(self.counts):
+            if count:
+                yield self.offset + i, count
+
+    def mean(self) -> float:
+        return sum(value * count for value, count in self.items()) / self.total
+
+    def at_least(self, target: int) -> float:
+        index = max(target - self.offset, 0)
+        return sum(self.counts[index:]) / self.total
+
+    def ranks(self) -> typing.List[float]:
+        """
+        Share of outcomes below each outcome, ties counted as half.
+        """
+        result = []
+        below = 0
+        for count in self.counts:
+            result.append((below * 2 + count) / (self.total * 2))
+            below += count
+        return result
+
+    def percentile(self, p: float) -> int:
+        """
+        The smallest outcome which is greater than or equal to `p` of all outcomes.
+        """
+        accumulated = 0
+        for value, count in self.items():
+            accumulated += count
+            if accumulated >= p * self.total:
+                return value
+        return self.maximum
+
+
+def cost(value) -> int:
+    """
+    Rough size in bytes of a cached result, the counts dominate it.
+    """
+    if isinstance(value, Distribution):
+        counts = value.counts
+    elif isinstance(value, dict):
+        counts = value.values()
+    else:
+        return 64
+    return sum(count.bit_length() // 8 + 32 for count in counts) + 64
+
+
+class SizedCache:
+    """
+    Least recently used results, evicted by their total size instead of their number.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = threading.Lock()
+        self.entries: typing.Dict[tuple, typing.Tuple[typing.Any, int]] = OrderedDict()
+
+    def get(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: tuple, value):
+        size = cost(value)
+        # one result larger than a quarter of the cache would evict most of the others
+        if size * 4 > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+cache = SizedCache(MAX_CACHE_BYTES)
+
+
+def cached(func):
+    @wraps(func)
+    def wrapper(*args):
+        key = (func.__name__,) + args
+        value = cache.get(key)
+        if value is None:
+            value = func(*args)
+            cache.put(key, value)
+        return value
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+def from_counter(outcomes: typing.Dict[int, int], total: int) -> Distribution:
+    offset = min(outcomes)
+    check_range(max(outcomes) - offset + 1)
+    counts = [0] * (max(outcomes) - offset + 1)
+    for value, count in outcomes.items():
+        counts[value - offset] = count
+    return Distribution(offset, counts, total)
+
+
+def check_range(size: int):
+    if size > MAX_RANGE:
+        raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+
+
+def constant(value: int) -> Distribution:
+    return Distribution(value, [1], 1)
+
+
+def pack(xs: typing.List[int], width: int) -> int:
+    return int.from_bytes(b''.join(x.to_bytes(width, 'little') for x in xs), 'little')
+
+
+def unpack(x: int, width: int, length: int) -> typing.List[int]:
+    data = x.to_bytes(length * width, 'little')
+    return [int.from_bytes(data[i:i + width], 'little') for i in range(0, len(data), width)]
+
+
+def convolve(a: typing.List[int], b: typing.List[int]) -> typing.List[int]:
+    """
+    Multiply two polynomials by packing the coefficients into big integers (Kronecker substitution).
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if len(b) == 1:
+        return [x * b[0] for x in a]
+    length = len(a) + len(b) - 1
+    check_range(length)
+    width = (max(a).bit_length() + max(b).bit_length() + len(b).bit_length()) // 8 + 1
+    if length * width * 8 > MAX_BITS:
+        raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+    return unpack(pack(a, width) * pack(b, width), width, length)
+
+
+@cached
+def dice_sum(counter: int, face: int) -> Distribution:
+    if counter == 0 or face == 0:
+        return constant(0)
+    elif face == 1:
+        return constant(counter)
+    length = counter * (face - 1) + 1
+    check_range(length)
+    # (x^1 + x^2 + ... + x^face)^counter, every coefficient is less than face^counter
+    width = counter * face.bit_length() // 8 + 1
+    if length * width * 8 > MAX_BITS:
+        raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+    counts = unpack(pack([1] * face, width) ** counter, width, length)
+    return Distribution(counter, counts, face ** counter)
+
+
+def check_power_size(counter: int, face: int):
+    """
+    Refuse `face` counts of up to `face ** counter` before they are computed.
+    """
+    check_range(face)
+    if face * counter * face.bit_length() > MAX_BITS:
+        raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+
+
+@cached
+def dice_max(counter: int, face: int) -> Distribution:
+    if counter == 0 or face == 0:
+        return constant(0)
+    check_power_size(counter, face)
+    # P(max <= k) = (k / face)^counter
+    counts = [k ** counter - (k - 1) ** counter for k in range(1, face + 1)]
+    return Distribution(1, counts, face ** counter)
+
+
+@cached
+def dice_min(counter: int, face: int) -> Distribution:
+    if counter == 0 or face == 0:
+        return constant(0)
+    check_power_size(counter, face)
+    # P(min >= k) = ((face - k + 1) / face)^counter
+    counts = [(face - k + 1) ** counter - (face - k) ** counter for k in range(1, face + 1)]
+    return Distribution(1, counts, face ** counter)
+
+
+@cached
+def exploding_die(face: int) -> Distribution:
+    """
+    One die rerolled and added on the highest face, `dice.EXPLODE_DEPTH` times at most.
+    """
+    depth = dice.EXPLODE_DEPTH
+    check_range((depth + 1) * face)
+    counts = []
+    for k in range(depth):
+        # `k` rerolls before, every sequence of the remaining rerolls is counted
+        counts.extend([face ** (depth - k)] * (face - 1))
+        counts.append(0)
+    counts.extend([1] * face)
+    return Distribution(1, counts, face ** (depth + 1))
+
+
+def power(a: Distribution, n: int) -> Distribution:
+    result = constant(0)
+    while n:
+        if n & 1:
+            result = combine(Add('+'), result, a)
+        n >>= 1
+        if n:
+            a = combine(Add('+'), a, a)
+    return result
+
+
+def keep_lowest(keep: typing.Optional[str], keep_counter: int, size: int) -> typing.Tuple[bool, int]:
+    """
+    Whether the lowest dice are kept, and how many of the `size` dice.
+    """
+    if keep is None:
+        return False, size
+    elif keep == 'dh':
+        return True, max(size - keep_counter, 0)
+    elif keep == 'dl':
+        return False, max(size - keep_counter, 0)
+    return keep == 'kl', min(keep_counter, size)
+
+
+@cached
+def selected(counter: int, face: int, lowest: bool, kept: int, reduce=sum) -> Distribution:
+    """
+    `sum`, `max` or `min` of the `kept` highest (or lowest) of `counter` dice.
+
+    The dice are assigned to the faces from the first kept to the last, counting the ways
+    to choose `j` of the remaining dice for each face, so the rolls are never enumerated.
+    """
+    if counter == 0 or face == 0:
+        return constant(0)
+    elif kept == 0:
+        return Distribution(0, [face ** counter], face ** counter)
+    # after the first face there is a state for each number of dice assigned, and the second face visits
+    # all of them for each number of dice, the ways have up to `counter * face.bit_length()` bits
+    states_size = counter + 1
+    if face > 1:
+        states_size += (counter + 1) ** 2
+    if states_size > MAX_STATES or (counter + 1) * counter * face.bit_length() > MAX_BITS:
+        raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+    faces = range(1, face + 1) if lowest else range(face, 0, -1)
+    # (dice assigned, result of the kept dice) -> ways
+    states = {(0, None): 1}
+    visited = 0
+    for value in faces:
+        visited += len(states) * (counter + 1)
+        if visited > MAX_STATES:
+            raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+        next_states = {}
+        for (assigned, result), ways in states.items():
+            left = counter - assigned
+            for j in range(left + 1):
+                taken = min(j, max(kept - assigned, 0))
+                if taken == 0:
+                    next_result = result
+                elif reduce is sum:
+                    next_result = (result or 0) + value * taken
+                else:
+                    next_result = value if result is None else reduce(result, value)
+                key = (assigned + j, next_result)
+                next_states[key] = next_states.get(key, 0) + ways * comb(left, j)
+        states = next_states
+    result = {}
+    for (assigned, value), ways in states.items():
+        if assigned == counter:
+            result[value] = result.get(value, 0) + ways
+    return from_counter(result, face ** counter)
+
+
+@cached
+def exploding_pool(counter: int, face: int) -> typing.Dict[typing.Tuple[int, int], int]:
+    """
+    Ways to roll `(highest faces, dice which never stopped exploding)` in the pool of `counter` exploding dice.
+
+    Every die stops at a lower face unless it explodes `dice.EXPLODE_DEPTH` times, the stopping faces are
+    left out of the count and rolled with `selected`.
+    """
+    depth = dice.EXPLODE_DEPTH
+    # `k` highest faces before stopping, every sequence of the remaining rerolls is counted
+    chain = [((k, 0), face ** (depth - k)) for k in range(depth + 1)] + [((depth + 1, 1), 1)]
+    pool = {(0, 0): 1}
+    visited = 0
+    for _ in range(counter):
+        visited += len(pool) * len(chain)
+        if visited > MAX_STATES:
+            raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+        next_pool = {}
+        for (highest, endless), ways in pool.items():
+            for (k, z), chain_ways in chain:
+                key = (highest + k, endless + z)
+                next_pool[key] = next_pool.get(key, 0) + ways * chain_ways
+        pool = next_pool
+    return pool
+
+
+@cached
+def kept_dice(counter: int, face: int, explode: bool, keep: typing.Optional[str], keep_counter: int,
+              reduce=sum) -> Distribution:
+    """
+    `sum`, `max` or `min` of the kept dice, the same as `Dice.eval`. `keep` is one of `kh`, `kl`, `dh`, `dl`
+    and `None`, the dice added by explosions can be kept or dropped like the others.
+    """
+    if not explode or face < 2:
+        lowest, kept = keep_lowest(keep, keep_counter, counter)
+        return selected(counter, face, lowest, kept, reduce)
+    result = {}
+    for (highest, endless), ways in exploding_pool(counter, face).items():
+        stopped = counter - endless
+        lowest, kept = keep_lowest(keep, keep_counter, highest + stopped)
+        # the highest faces are kept first, or after all the stopping faces
+        kept_stopped = min(kept, stopped) if lowest else max(kept - highest, 0)
+        kept_highest = kept - kept_stopped
+        for value, count in selected(stopped, face - 1, lowest, kept_stopped, reduce).items():
+            if reduce is sum:
+                value += kept_highest * face
+            elif kept_highest and kept_stopped:
+                value = reduce(value, face)
+            elif kept_highest:
+                value = face
+            result[value] = result.get(value, 0) + ways * count
+    return from_counter(result, face ** ((dice.EXPLODE_DEPTH + 1) * counter))
+
+
+def dice_distribution(node, env: Env, reduce=sum) -> Distribution:
+    counter, face = node.counter_face(env)
+    explode, keep, keep_counter = node.modifiers()
+    if keep is None and explode and reduce is sum and face > 1:
+        # the size of the last product, refused before the smaller ones are computed
+        depth = dice.EXPLODE_DEPTH
+        length = counter * ((depth + 1) * face - 1) + 1
+        check_range(length)
+        if length * counter * (depth + 1) * face.bit_length() > MAX_BITS:
+            raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+        return power(exploding_die(face), counter)
+    elif explode or keep is not None:
+        return kept_dice(counter, face, explode, keep, keep_counter, reduce)
+    elif reduce is max:
+        return dice_max(counter, face)
+    elif reduce is min:
+        return dice_min(counter, face)
+    return dice_sum(counter, face)
+
+
+def negate(a: Distribution) -> Distribution:
+    return Distribution(-a.maximum, a.counts[::-1], a.total)
+
+
+def combine(op, a: Distribution, b: Distribution) -> Distribution:
+    if isinstance(op, Add):
+        return Distribution(a.offset + b.offset, convolve(a.counts, b.counts), a.total * b.total)
+    elif isinstance(op, Sub):
+        return combine(Add('+'), a, negate(b))
+    if isinstance(op, Div) and b.minimum <= 0 <= b.maximum and b.counts[-b.offset]:
+        raise RollError(DiceErrorKind.ZERO_DIVISION)
+    a_items = list(a.items())
+    b_items = list(b.items())
+    if len(a_items) * len(b_items) > MAX_PAIRS:
+        raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+    result = {}
+    for x, x_count in a_items:
+        for y, y_count in b_items:
+            value = x * y if isinstance(op, Mul) else x // y
+            result[value] = result.get(value, 0) + x_count * y_count
+    return from_counter(result, a.total * b.total)
+
+
+def fold(values: list, operators: list, join=combine):
+    """
+    Combine the operands in the same order as `Expr.eval`, `×` and `÷` first.
+    """
+    terms = [values[0]]
+    term_operators = []
+    for op, value in zip(operators, values[1:]):
+        if isinstance(op, (Mul, Div)):
+            terms[-1] = join(op, terms[-1], value)
+        else:
+            term_operators.append(op)
+            terms.append(value)
+    result = terms[0]
+    for op, value in zip(term_operators, terms[1:]):
+        result = join(op, result, value)
+    return result
+
+
+def distribution(node, env: Env) -> Distribution:
+    if isinstance(node, dice.Number):
+        return constant(int(node.name))
+    elif isinstance(node, dice.Dice):
+        return dice_distribution(node, env)
+    elif isinstance(node, dice.Max):
+        return dice_distribution(node.dice, env, max)
+    elif isinstance(node, dice.Min):
+        return dice_distribution(node.dice, env, min)
+    elif isinstance(node, dice.Repeat):
+        return distribution(node.expr, env)
+    elif isinstance(node, (dice.Group, dice.Expr)):
+        items = node.items if isinstance(node, dice.Group) else node
+        values = [distribution(x, env) for x in items if not isinstance(x, dice.Operator)]
+        operators = [x for x in items if isinstance(x, dice.Operator)]
+        return fold(values, operators)
+    raise TypeError('unknown node {!r}'.format(node))
+
+
+Bounds = typing.Tuple[int, int, int]
+
+
+def dice_bounds(node, env: Env, single=False) -> Bounds:
+    counter, face = node.counter_face(env)
+    explode, _, _ = node.modifiers()
+    rolls = dice.EXPLODE_DEPTH + 1 if explode else 1
+    highest = face * rolls
+    # the outcomes of `counter` dice, which are rolled `rolls` times at most
+    bits = counter * rolls * face.bit_length()
+    return 0, highest if single else counter * highest, bits
+
+
+def combine_bounds(op, a: Bounds, b: Bounds) -> Bounds:
+    bits = a[2] + b[2]
+    if isinstance(op, Add):
+        return a[0] + b[0], a[1] + b[1], bits
+    elif isinstance(op, Sub):
+        return a[0] - b[1], a[1] - b[0], bits
+    elif isinstance(op, Mul):
+        corners = [x * y for x in a[:2] for y in b[:2]]
+        return min(corners), max(corners), bits
+    largest = max(abs(a[0]), abs(a[1]))
+    return -largest, largest, bits
+
+
+def bounds(node, env: Env) -> Bounds:
+    """
+    The lowest and the highest outcome, and the bits of the number of all outcomes, without computing the
+    distribution. The distributions of every part of the expression are within these.
+    """
+    if isinstance(node, dice.Number):
+        return int(node.name), int(node.name), 0
+    elif isinstance(node, dice.Dice):
+        return dice_bounds(node, env)
+    elif isinstance(node, (dice.Max, dice.Min)):
+        return dice_bounds(node.dice, env, single=True)
+    elif isinstance(node, dice.Repeat):
+        return bounds(node.expr, env)
+    elif isinstance(node, dice.Group):
+        items = node.items
+    elif isinstance(node, dice.Expr):
+        items = node
+    else:
+        raise TypeError('unknown node {!r}'.format(node))
+    values = [bounds(x, env) for x in items if not isinstance(x, dice.Operator)]
+    operators = [x for x in items if isinstance(x, dice.Operator)]
+    return fold(values, operators, combine_bounds)
+
+
+def check_size(node, env: Env):
+    """
+    Refuse an expression before anything is computed, if its distribution would be too large.
+    """
+    minimum, maximum, bits = bounds(node, env)
+    size = maximum - minimum + 1
+    check_range(size)
+    if size * bits > MAX_BITS:
+        raise RollError(DiceErrorKind.PROBABILITY_TOO_COMPLEX)
+
+
+def expression_range(text: str, default_dice_face: int) -> int:
+    """
+    An upper bound of the number of outcomes of the first expression in the text, 0 if there is not any.
+    """
+    for item in dice.parse_roll(text):
+        if not isinstance(item, str):
+            minimum, maximum, _ = bounds(item, Env(face=default_dice_face))
+            return maximum - minimum + 1
+    return 0
+
+
+@cached
+def expression_distribution(text: str, default_dice_face: int) -> typing.Optional[Distribution]:
+    """
+    Distribution of the first expression in the text, `None` if there is not any.
+    """
+    for item in dice.parse_roll(text):
+        if not isinstance(item, str):
+            env = Env(face=default_dice_face)
+            check_size(item, env)
+            return distribution(item, env)
+    return None
@@ -0,0 +1,164 @@
+import os
+import random
+import threading
+from array import array
+from functools import lru_cache
+from typing import List, Iterator, Sequence
+
+
+class EntropyPool:
+    """
+    Random bytes from `os.urandom` drawn in bulk, each byte is handed out only once.
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.lock = threading.Lock()
+        self.buffer = b''
+        self.offset = 0
+
+    def reset(self):
+        with self.lock:
+            self.buffer = b''
+            self.offset = 0
+
+    def take(self, n: int) -> bytes:
+        if n > self.size:
+            return os.urandom(n)
+        with self.lock:
+            end = self.offset + n
+            if end > len(self.buffer):
+                self.buffer = os.urandom(self.size)
+                self.offset = 0
+                end = n
+            data = self.buffer[self.offset:end]
+            self.offset = end
+        return data
+
+    def sample(self, face: int, need: int) -> bytes:
+        # draw a bit more than needed to cover the rejected values
+        width, limit = sample_range(face)
+        return self.take((need + need * (256 ** width - limit) // limit + 1) * width)
+
+    def roll(self, face: int, counter: int) -> List[int]:
+        """
+        Roll `counter` dice with `face` faces, values out of range are rejected to keep it unbiased.
+        """
+        if face < 2:
+            return [face] * counter
+        width, limit = sample_range(face)
+        result = []
+        while len(result) < counter:
+            data = self.sample(face, counter - len(result))
+            if width == 1:
+                values = data
+            else:
+                values = [int.from_bytes(data[i:i + width], 'big') for i in range(0, len(data), width)]
+            result.extend([x % face + 1 for x in values if x < limit])
+        del result[counter:]
+        return result
+
+    def packed(self, face: int, counter: int, chunk=4096) -> Iterator[Sequence[int]]:
+        """
+        Zero based results of a large roll, yielded in chunks of packed integers.
+        """
+        width, limit = sample_range(face)
+        while counter > 0:
+            need = min(counter, chunk)
+            data = self.sample(face, need)
+            if width == 1:
+                table, rejected = byte_table(face)
+                values = data.translate(table, rejected)
+            elif width == 2:
+                values = array('H', map(face.__rmod__, filter(limit.__gt__, array('H', data))))
+            else:
+                values = [x - 1 for x in self.roll(face, need)]
+            values = values[:counter]
+            if not values:
+                # every byte of a small sample can be rejected, `max` and `min` need a value
+                continue
+            counter -= len(values)
+            yield values
+
+
+class SeededSource:
+    """
+    Deterministic results from a seeded `random.Random`, for replays and load tests.
+    """
+    def __init__(self, seed):
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def reset(self):
+        pass
+
+    def roll(self, face: int, counter: int) -> List[int]:
+        if face < 2:
+            return [face] * counter
+        randrange = self.random.randrange
+        with self.lock:
+            return [randrange(face) + 1 for _ in range(counter)]
+
+    def packed(self, face: int, counter: int, chunk=4096) -> Iterator[Sequence[int]]:
+        while counter > 0:
+            need = min(counter, chunk)
+            counter -= need
+            yield [x - 1 for x in self.roll(face, need)]
+
+
+@lru_cache(maxsize=None)
+def sample_range(face: int):
+    """
+    Bytes per sample and the rejection limit (a multiple of `face`).
+    """
+    width = ((face - 1).bit_length() + 7) // 8
+    limit = (1 << (width * 8)) // face * face
+    return width, limit
+
+
+@lru_cache(maxsize=256)
+def byte_table(face: int):
+    """
+    `bytes.translate` arguments which map a byte to a zero based face and drop rejected bytes.
+    """
+    _, limit = sample_range(face)
+    return bytes(x % face for x in range(256)), bytes(range(limit, 256))
+
+
+# the source of every roll, looked up on each call so switching it costs nothing
+pool = EntropyPool()
+
+# the child process must not reuse the bytes of the parent
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: pool.reset())
+
+
+def use_seed(seed=None):
+    """
+    Roll from a seeded deterministic source in this process, or from the entropy pool if `seed` is `None`.
+    """
+    global pool
+    pool = EntropyPool() if seed is None else SeededSource(seed)
+
+
+def roll(face: int, counter=1) -> List[int]:
+    return pool.roll(face, counter)
+
+
+def randint(face: int) -> int:
+    """
+    A number in [1, face].
+    """
+    return pool.roll(face, 1)[0]
+
+
+def roll_reduce(face: int, counter: int, reduce=sum) -> int:
+    """
+    `sum`, `max` or `min` of a large roll, without keeping every result.
+    """
+    if face < 2:
+        return reduce(roll(face, counter))
+    result = reduce(reduce(chunk) for chunk in pool.packed(face, counter))
+    if reduce is sum:
+        return result + counter
+    return result + 1
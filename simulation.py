@@ -0,0 +1,57 @@
+"""
+Monte Carlo estimates of outcome frequencies, sampled in fixed-size chunks until they are precise enough.
+"""
+import math
+import time
+import typing
+from collections import Counter
+
+CHUNK = 2000
+MAX_TRIALS = 1000000
+# stop once every frequency is known within this, at 95% confidence
+PRECISION = 0.005
+Z = 1.96
+
+
+class Simulation:
+    def __init__(self):
+        self.counts = Counter()
+        self.trials = 0
+        self.cpu_time = 0.0
+
+    def update(self, outcomes: typing.Iterable):
+        before = sum(self.counts.values())
+        self.counts.update(outcomes)
+        self.trials += sum(self.counts.values()) - before
+
+    def frequency(self, outcome) -> float:
+        if self.trials == 0:
+            return 0.0
+        return self.counts[outcome] / self.trials
+
+    def error(self, outcome) -> float:
+        """
+        Half width of the 95% confidence interval, adjusted (Agresti-Coull) to stay sane near 0 and 1.
+        """
+        n = self.trials + Z * Z
+        p = (self.counts[outcome] + Z * Z / 2) / n
+        return Z * math.sqrt(p * (1 - p) / n)
+
+    def precise(self, precision: float) -> bool:
+        return self.trials > 0 and all(self.error(outcome) <= precision for outcome in self.counts)
+
+
+def simulate(sample: typing.Callable[[int], typing.Iterable], cpu_time: float,
+             precision=PRECISION, chunk=CHUNK, max_trials=MAX_TRIALS) -> Simulation:
+    """
+    `sample(n)` returns the outcomes of `n` trials. Stops early when the result is precise enough,
+    or after `cpu_time` seconds of CPU time in this thread.
+    """
+    result = Simulation()
+    start = time.thread_time()
+    while result.trials < max_trials:
+        result.update(sample(min(chunk, max_trials - result.trials)))
+        result.cpu_time = time.thread_time() - start
+        if result.precise(precision) or result.cpu_time >= cpu_time:
+            break
+    return result